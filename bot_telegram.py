@@ -7,6 +7,7 @@ import requests
 import socket
 from datetime import datetime, timedelta
 from telebot import types
+from telebot.apihelper import ApiTelegramException
 from requests.exceptions import ConnectionError, Timeout, RequestException
 from urllib3.exceptions import NewConnectionError, MaxRetryError
 from supabase import create_client, Client
@@ -14,23 +15,160 @@ import re
 from bs4 import BeautifulSoup
 import pytz
 import sys
+import threading
+import atexit
+import hmac
+import signal
+import heapq
+import itertools
+import uuid
+import sqlite3
+import gzip
+import mmap
+import select
+import struct
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict, deque, Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 # Configuración del bot
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
+# Almacenamiento de usuarios y logs: 'supabase', 'postgres' (directo), 'sqlite' (archivo local) o 'memory' (pruebas)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'supabase').lower()
+STORAGE_SQLITE_PATH = os.getenv('STORAGE_SQLITE_PATH', 'bot_data.db')
+# Backend 'postgres': conexión directa al Postgres de Supabase (cadena de conexión de Settings > Database)
+DATABASE_URL = os.getenv('DATABASE_URL')
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', 1))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', 10))
+# Copia local (SQLite) de Supabase/Postgres: atiende escrituras y lecturas aunque el remoto esté caído
+STORAGE_MIRROR_PATH = os.getenv('STORAGE_MIRROR_PATH')
+MIRROR_SYNC_INTERVAL = float(os.getenv('MIRROR_SYNC_INTERVAL', 10))
+MIRROR_SYNC_BATCH = int(os.getenv('MIRROR_SYNC_BATCH', 200))
+# Intentos (con el remoto disponible) antes de apartar una operación en mirror_dead_ops
+MIRROR_MAX_ATTEMPTS = int(os.getenv('MIRROR_MAX_ATTEMPTS', 5))
+
+# Log de auditoría con escritura diferida (buffer en memoria + volcado por lotes)
+AUDIT_FLUSH_INTERVAL_MS = int(os.getenv('AUDIT_FLUSH_INTERVAL_MS', 2000))
+AUDIT_FLUSH_MAX_ROWS = int(os.getenv('AUDIT_FLUSH_MAX_ROWS', 100))
+AUDIT_BUFFER_MAX_ROWS = int(os.getenv('AUDIT_BUFFER_MAX_ROWS', 10000))
+AUDIT_SPILL_PATH = os.getenv('AUDIT_SPILL_PATH', 'audit_spill.jsonl')
+
+# Mantenimiento del log: resumen diario, archivo comprimido y borrado de filas antiguas
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 30))
+LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', 'log_archive')
+LOG_MAINTENANCE_INTERVAL = int(os.getenv('LOG_MAINTENANCE_INTERVAL', 6 * 3600))
+LOG_MAINTENANCE_BATCH = int(os.getenv('LOG_MAINTENANCE_BATCH', 1000))
+
+# Carga inicial paginada de usuarios (PostgREST limita las filas por respuesta)
+STARTUP_LOAD_PAGE_SIZE = int(os.getenv('STARTUP_LOAD_PAGE_SIZE', 1000))
+
+# Instantánea local de los usuarios para arrancar sin esperar a la base de datos
+USER_SNAPSHOT_PATH = os.getenv('USER_SNAPSHOT_PATH', 'users_snapshot.bin')
+USER_SNAPSHOT_INTERVAL = int(os.getenv('USER_SNAPSHOT_INTERVAL', 300))
+USER_SYNC_CLOCK_MARGIN = int(os.getenv('USER_SYNC_CLOCK_MARGIN', 60))  # Solapamiento al pedir cambios (segundos)
+USER_TOMBSTONE_RETENTION_DAYS = int(os.getenv('USER_TOMBSTONE_RETENTION_DAYS', 30))
+# Cada cuántos segundos se aplican los cambios de usuarios hechos por otras instancias (0 = desactivado)
+REPLICA_SYNC_INTERVAL = float(os.getenv('REPLICA_SYNC_INTERVAL', 5))
+
+# Listados paginados con botones anterior/siguiente (/registered, /listamensajes)
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 10))
+PAGED_VIEW_MAX = int(os.getenv('PAGED_VIEW_MAX', 500))  # Vistas recordadas para los botones
+
+# Consultas concurrentes de miembros (get_chat_member) para los comandos de mención
+MEMBER_LOOKUP_WORKERS = int(os.getenv('MEMBER_LOOKUP_WORKERS', 16))
+MEMBER_LOOKUP_TIMEOUT = float(os.getenv('MEMBER_LOOKUP_TIMEOUT', 10))
+
+# Índice local de miembros por chat (alimentado por actualizaciones chat_member)
+MEMBERSHIP_INDEX_PATH = os.getenv('MEMBERSHIP_INDEX_PATH', 'membership_index.json')
+MEMBERSHIP_INDEX_SAVE_INTERVAL = int(os.getenv('MEMBERSHIP_INDEX_SAVE_INTERVAL', 30))
+
+# Tiempo de vida (segundos) de las menciones precalculadas por chat
+MENTION_ROSTER_TTL = int(os.getenv('MENTION_ROSTER_TTL', 300))
+# Tiempo de vida más corto para las menciones incompletas (alguna consulta falló)
+MENTION_ROSTER_PARTIAL_TTL = int(os.getenv('MENTION_ROSTER_PARTIAL_TTL', 30))
+
+# Tiempo de vida (segundos) de los metadatos de chat (administradores, cantidad de miembros)
+CHAT_METADATA_TTL = int(os.getenv('CHAT_METADATA_TTL', 300))
+
+# Modo de renderizado de menciones: 'entities' (texto + MessageEntity) o 'markdown'
+MENTION_RENDER_MODE = os.getenv('MENTION_RENDER_MODE', 'entities').lower()
+
+# Límites de Telegram por mensaje: longitud del texto y cantidad de menciones
+MAX_MESSAGE_LENGTH = 4096
+MAX_MENTIONS_PER_MESSAGE = int(os.getenv('MAX_MENTIONS_PER_MESSAGE', 50))
+
+# Planificador de envíos salientes (límites de Telegram: ~30 msg/s global,
+# ~1 msg/s por chat y 20 msg/min por grupo)
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', 30))
+# Procesos que envían con el mismo token (bot + `--outbox-worker`): el límite global se reparte entre ellos
+SEND_PROCESSES = max(int(os.getenv('SEND_PROCESSES', 1)), 1)
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', 1))
+CHAT_SEND_BURST = int(os.getenv('CHAT_SEND_BURST', 3))
+GROUP_SEND_PER_MINUTE = int(os.getenv('GROUP_SEND_PER_MINUTE', 20))
+# Ráfaga por grupo: con capacidad = GROUP_SEND_PER_MINUTE saldrían ~2x por minuto (balde lleno + recarga)
+GROUP_SEND_BURST = max(int(os.getenv('GROUP_SEND_BURST', 3)), 1)
+OUTBOUND_SEND_WORKERS = int(os.getenv('OUTBOUND_SEND_WORKERS', 8))
+FLOOD_WAIT_MAX_RETRIES = int(os.getenv('FLOOD_WAIT_MAX_RETRIES', 5))
+
+# Difusiones de mensajes directos en segundo plano
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 2))
+BROADCAST_JOB_HISTORY = int(os.getenv('BROADCAST_JOB_HISTORY', 50))
+# Token para consultar /broadcasts en el servidor web (sin token el endpoint queda desactivado)
+BROADCASTS_TOKEN = os.getenv('BROADCASTS_TOKEN')
+
+# Bandeja de salida persistente de difusiones: 'supabase' o 'sqlite' (local; por defecto si no se usa Supabase)
+OUTBOX_BACKEND = os.getenv('OUTBOX_BACKEND', 'supabase' if STORAGE_BACKEND == 'supabase' else 'sqlite').lower()
+OUTBOX_SQLITE_PATH = os.getenv('OUTBOX_SQLITE_PATH', 'outbox.db')
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 2))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+OUTBOX_CLAIM_TIMEOUT = int(os.getenv('OUTBOX_CLAIM_TIMEOUT', 300))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+# Espera (segundos) antes de reintentar una fila fallida; se duplica con cada intento
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', 30))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', 3600))
+# Horas que se conservan las filas ya enviadas antes de borrarlas
+OUTBOX_SENT_RETENTION_HOURS = float(os.getenv('OUTBOX_SENT_RETENTION_HOURS', 24))
+OUTBOX_CLEANUP_INTERVAL = int(os.getenv('OUTBOX_CLEANUP_INTERVAL', 3600))
+
+# Proceso dedicado solo a vaciar la bandeja de salida (`python bot_telegram.py --outbox-worker`):
+# no escribe los archivos locales del bot ni toca el webhook
+OUTBOX_WORKER_MODE = __name__ == '__main__' and '--outbox-worker' in sys.argv
+
+# Ventana (segundos) para agrupar en un solo mensaje directo las alertas seguidas de un chat
+DM_COALESCE_WINDOW = float(os.getenv('DM_COALESCE_WINDOW', 5))
+
+# Caché negativa de destinatarios que no pueden recibir mensajes directos
+DM_NEGATIVE_CACHE_PATH = os.getenv('DM_NEGATIVE_CACHE_PATH', 'dm_negative_cache.json')
+DM_NEGATIVE_CACHE_SAVE_INTERVAL = int(os.getenv('DM_NEGATIVE_CACHE_SAVE_INTERVAL', 60))
+DM_NEGATIVE_CACHE_MAX_INTERVAL = int(os.getenv('DM_NEGATIVE_CACHE_MAX_INTERVAL', 7 * 24 * 3600))
+# Intervalo base (segundos) antes de volver a probar, por tipo de fallo; se duplica con cada fallo
+DM_FAILURE_BASE_INTERVALS = {
+    'cant_initiate': int(os.getenv('DM_RETRY_CANT_INITIATE', 3600)),
+    'forbidden': int(os.getenv('DM_RETRY_FORBIDDEN', 6 * 3600)),
+    'bad_request': int(os.getenv('DM_RETRY_BAD_REQUEST', 600))
+}
+
 if not BOT_TOKEN:
     print("❌ ERROR: BOT_TOKEN no está configurado")
     exit(1)
 
-if not SUPABASE_URL or not SUPABASE_KEY:
+if 'supabase' in (STORAGE_BACKEND, OUTBOX_BACKEND) and (not SUPABASE_URL or not SUPABASE_KEY):
     print("❌ ERROR: SUPABASE_URL y SUPABASE_KEY no están configurados")
     print("💡 Configura estas variables de entorno en Render:")
     print("   SUPABASE_URL=https://tu-proyecto.supabase.co")
     print("   SUPABASE_KEY=tu-clave-supabase")
     exit(1)
 
+if STORAGE_BACKEND == 'postgres' and not DATABASE_URL:
+    print("❌ ERROR: DATABASE_URL no está configurado (necesario con STORAGE_BACKEND=postgres)")
+    print("💡 Usa la cadena de conexión directa de Supabase (Settings > Database, puerto 5432)")
+    exit(1)
+
 # Aplicar parche temporal para el error de Story
 def apply_story_patch():
     """Aplica un parche temporal para el error de compatibilidad con Story"""
@@ -59,6 +197,9 @@ def apply_story_patch():
 # Aplicar el parche antes de crear el bot
 apply_story_patch()
 
+# Habilitar middlewares para observar todos los mensajes (índice de miembros)
+telebot.apihelper.ENABLE_MIDDLEWARE = True
+
 # Crear instancia del bot
 bot = telebot.TeleBot(BOT_TOKEN)
 
@@ -73,117 +214,1328 @@ logging.basicConfig(
 )
 
 # Configuración de Supabase (Base de datos en la nube)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else None
 
-def init_database():
-    """Inicializa la base de datos en Supabase (PostgreSQL en la nube)"""
-    try:
-        # Verificar conexión probando las tablas
-        supabase.table('registered_users').select('user_id').limit(1).execute()
+USER_TABLES = ('registered_users', 'direct_message_users')
+# Códigos de "la tabla o vista no existe": Postgres (42P01) y PostgREST (PGRST205)
+MISSING_RELATION_CODES = ('42P01', 'PGRST205')
+USER_LIST_COLUMNS = 'user_id, username, first_name, last_name, registered_at'
+LOG_COLUMNS = 'id, user_id, action, details, timestamp'
+
+def utc_timestamp(value=None):
+    """Timestamp ISO en UTC con microsegundos (ancho fijo, se puede comparar como texto)"""
+    dt = datetime.now(pytz.utc) if value is None else datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(pytz.utc).isoformat(timespec='microseconds')
+
+def user_log_details(username, first_name, last_name):
+    """Detalle del log para un usuario"""
+    return f"Username: {username}, Nombre: {first_name} {last_name}"
+
+def chunked(items, size):
+    """Divide una lista en trozos de como máximo `size` elementos"""
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+class StorageBackend:
+    """Interfaz de almacenamiento de usuarios y del log de acciones
+
+    Los métodos lanzan excepción si fallan; las funciones del bot que los usan
+    se encargan de registrar el error.
+    """
+    name = 'base'
+
+    def check(self):
+        """Verifica que el almacenamiento esté disponible y las tablas existan"""
+        raise NotImplementedError
+
+    def backup(self):
+        """Crea o confirma un respaldo. Devuelve True si hay respaldo"""
+        raise NotImplementedError
+
+    def load_user_ids(self, table):
+        """Todos los user_id de una tabla de usuarios"""
+        raise NotImplementedError
+
+    def get_user(self, table, user_id):
+        """Datos de un usuario (username, first_name, last_name, registered_at) o None"""
+        raise NotImplementedError
+
+    def get_users(self, table, user_ids):
+        """Datos de varios usuarios; los que no existen se omiten"""
+        users = (self.get_user(table, user_id) for user_id in user_ids)
+        return [user for user in users if user]
+
+    def upsert_registered_user(self, user_id, username, first_name, last_name, is_new_user=None):
+        """Registra o actualiza un usuario y su log. Devuelve True si es nuevo
+
+        `is_new_user` lo indica quien ya aplicó el cambio en otra copia (MirroredStorage):
+        los backends que no pueden saberlo en la misma transacción lo usan para el log.
+        """
+        raise NotImplementedError
+
+    def insert_direct_message_user(self, user_id, username, first_name, last_name):
+        """Registra un usuario de mensajes directos (y su log) si no existe. Devuelve True si es nuevo"""
+        raise NotImplementedError
+
+    def delete_users(self, table, user_ids):
+        """Elimina usuarios y devuelve las filas eliminadas"""
+        raise NotImplementedError
+
+    def insert_logs(self, rows):
+        """Inserta filas en user_registration_log"""
+        raise NotImplementedError
+
+    def fetch_user_rows(self, table, cursor, limit):
+        """Usuarios ordenados por (registered_at, user_id) descendente, después del cursor"""
+        raise NotImplementedError
+
+    def fetch_log_rows(self, filters, cursor, limit):
+        """Filas del log ordenadas por (timestamp, id) descendente, filtradas y después del cursor"""
+        raise NotImplementedError
+
+    def fetch_logs_before(self, cutoff, limit):
+        """Filas del log anteriores a `cutoff`, ordenadas por id"""
+        raise NotImplementedError
+
+    def expire_logs(self, log_ids):
+        """Borra las filas del log con esos ids y las suma al resumen diario en una sola
+        transacción. Solo cuenta las que borró; devuelve cuántas fueron"""
+        raise NotImplementedError
+
+    def fetch_user_changes(self, since):
+        """Cambios de usuarios posteriores a `since` (vista user_changes): dicts con
+        table_name, user_id, changed_at y deleted. Sin registro de cambios lanza NotImplementedError"""
+        raise NotImplementedError
+
+    def listen_for_changes(self, callback):
+        """Llama a `callback` cuando otra instancia cambia usuarios. Devuelve False si no hay avisos"""
+        return False
+
+    def start(self):
+        """Inicia tareas en segundo plano del almacenamiento (si tiene)"""
+        pass
+
+    def close(self):
+        """Libera conexiones al apagar"""
+        pass
+
+class SupabaseStorage(StorageBackend):
+    """Almacenamiento en Supabase a través de PostgREST"""
+    name = 'Supabase'
+
+    def __init__(self, client):
+        self.client = client
+        # Funciones RPC de registro (ver SUPABASE_SETUP.md); se desactivan si no existen en la base
+        self.registration_rpc_available = True
+
+    def check(self):
+        self.client.table('registered_users').select('user_id').limit(1).execute()
         logging.info("✅ Tabla registered_users verificada")
         
-        supabase.table('user_registration_log').select('id').limit(1).execute()
+        self.client.table('user_registration_log').select('id').limit(1).execute()
         logging.info("✅ Tabla user_registration_log verificada")
+
+    def backup(self):
+        # Supabase tiene respaldo automático, solo confirmamos
+        logging.info("✅ Supabase tiene respaldo automático habilitado")
+        return True
+
+    def load_user_ids(self, table):
+        """Carga los user_id por páginas (range) ordenadas por user_id
+
+        PostgREST limita las filas por respuesta; se avanza según las filas
+        recibidas, así funciona aunque su max-rows sea menor que STARTUP_LOAD_PAGE_SIZE.
+        """
+        user_ids = set()
+        start = 0
+        while True:
+            result = self.client.table(table).select('user_id').order('user_id').range(start, start + STARTUP_LOAD_PAGE_SIZE - 1).execute()
+            if not result.data:
+                return user_ids
+            user_ids.update(row['user_id'] for row in result.data)
+            start += len(result.data)
+
+    def get_user(self, table, user_id):
+        result = self.client.table(table).select(USER_LIST_COLUMNS).eq('user_id', user_id).execute()
+        return result.data[0] if result.data else None
+
+    def get_users(self, table, user_ids):
+        users = []
+        for chunk in chunked(list(user_ids), 500):
+            users.extend(self.client.table(table).select(USER_LIST_COLUMNS).in_('user_id', chunk).execute().data or [])
+        return users
+
+    def call_registration_rpc(self, function_name, user_id, username, first_name, last_name):
+        """Llama a una función de registro (upsert + log en una transacción).
+
+        Devuelve True/False según si el usuario es nuevo, o None si la función no
+        está creada en Supabase y hay que usar el camino alternativo.
+        """
+        if not self.registration_rpc_available:
+            return None
+        try:
+            result = self.client.rpc(function_name, {
+                'p_user_id': user_id,
+                'p_username': username,
+                'p_first_name': first_name,
+                'p_last_name': last_name
+            }).execute()
+            return bool(result.data)
+        except Exception as e:
+            # PGRST202: la función no existe en el esquema
+            if getattr(e, 'code', None) == 'PGRST202':
+                logging.warning(f"⚠️ Función {function_name} no encontrada en Supabase, usando upsert + log")
+                self.registration_rpc_available = False
+                return None
+            raise
+
+    def upsert_registered_user(self, user_id, username, first_name, last_name, is_new_user=None):
+        rpc_is_new_user = self.call_registration_rpc('upsert_registered_user', user_id, username, first_name, last_name)
+        if rpc_is_new_user is not None:
+            return rpc_is_new_user
+        # Camino alternativo: upsert y log por separado. Sin indicación se consulta la
+        # tabla antes del upsert (el log lo escribe este mismo backend, no el buffer global)
+        if is_new_user is None:
+            is_new_user = self.get_user('registered_users', user_id) is None
+        user_data = {
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name
+        }
+        self.client.table('registered_users').upsert(user_data, on_conflict='user_id').execute()
         
-        logging.info("✅ Base de datos Supabase inicializada correctamente")
+        action = "REGISTRO" if is_new_user else "ACTUALIZACION"
+        self.insert_logs([{'user_id': user_id, 'action': action, 'details': user_log_details(username, first_name, last_name)}])
+        return is_new_user
+
+    def insert_direct_message_user(self, user_id, username, first_name, last_name):
+        is_new_user = self.call_registration_rpc('upsert_direct_message_user', user_id, username, first_name, last_name)
+        if is_new_user is None:
+            # Camino alternativo: insertar ignorando duplicados (solo devuelve filas nuevas) y luego el log
+            user_data = {
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name
+            }
+            result = self.client.table('direct_message_users').upsert(user_data, on_conflict='user_id', ignore_duplicates=True).execute()
+            is_new_user = bool(result.data)
+            
+            if is_new_user:
+                self.insert_logs([{'user_id': user_id, 'action': "REGISTRO_DIRECT_MESSAGE", 'details': user_log_details(username, first_name, last_name)}])
+        return is_new_user
+
+    def delete_users(self, table, user_ids):
+        # El DELETE devuelve las filas eliminadas
+        deleted = []
+        for chunk in chunked(list(user_ids), 500):
+            deleted.extend(self.client.table(table).delete().in_('user_id', chunk).execute().data or [])
+        return deleted
+
+    def insert_logs(self, rows):
+        for chunk in chunked(list(rows), AUDIT_FLUSH_MAX_ROWS):
+            self.client.table('user_registration_log').insert(chunk).execute()
+
+    def fetch_user_rows(self, table, cursor, limit):
+        query = self.client.table(table).select(USER_LIST_COLUMNS)
+        if cursor:
+            registered_at, user_id = cursor
+            query = query.or_(
+                f'registered_at.lt."{registered_at}",'
+                f'and(registered_at.eq."{registered_at}",user_id.lt.{user_id})'
+            )
+        # Un único parámetro order con ambas columnas (desempate estable por user_id)
+        return query.order('registered_at.desc,user_id', desc=True).limit(limit).execute().data
+
+    def fetch_log_rows(self, filters, cursor, limit):
+        query = self.client.table('user_registration_log').select(LOG_COLUMNS)
+        if 'user_id' in filters:
+            query = query.eq('user_id', filters['user_id'])
+        if 'action' in filters:
+            query = query.eq('action', filters['action'])
+        if 'since' in filters:
+            query = query.gte('timestamp', filters['since'])
+        if 'until' in filters:
+            query = query.lt('timestamp', filters['until'])
+        if cursor:
+            timestamp, log_id = cursor
+            query = query.or_(
+                f'timestamp.lt."{timestamp}",'
+                f'and(timestamp.eq."{timestamp}",id.lt.{log_id})'
+            )
+        return query.order('timestamp.desc,id', desc=True).limit(limit).execute().data
+
+    def fetch_logs_before(self, cutoff, limit):
+        return self.client.table('user_registration_log').select(LOG_COLUMNS).lt('timestamp', cutoff).order('id').limit(limit).execute().data
+
+    def expire_logs(self, log_ids):
+        # Borrado y resumen en la función expire_logs (una transacción en el servidor):
+        # con PostgREST un fallo entre ambos pasos, o dos instancias a la vez, duplicaría contadores
+        result = self.client.rpc('expire_logs', {'p_ids': list(log_ids)}).execute()
+        return result.data or 0
+
+    def fetch_user_changes(self, since):
+        # Páginas por keyset (changed_at, user_id); se termina con una página vacía
+        changes = []
+        cursor = None
+        while True:
+            query = self.client.table('user_changes').select('table_name, user_id, changed_at, deleted').gt('changed_at', since)
+            if cursor:
+                changed_at, user_id = cursor
+                query = query.or_(
+                    f'changed_at.gt."{changed_at}",'
+                    f'and(changed_at.eq."{changed_at}",user_id.gt.{user_id})'
+                )
+            try:
+                rows = query.order('changed_at,user_id').limit(STARTUP_LOAD_PAGE_SIZE).execute().data
+            except Exception as e:
+                # Sin la vista user_changes (SUPABASE_SETUP.md §11) no hay registro de cambios
+                if getattr(e, 'code', None) in MISSING_RELATION_CODES:
+                    raise NotImplementedError("la vista user_changes no existe") from e
+                raise
+            if not rows:
+                return changes
+            changes.extend(rows)
+            cursor = (rows[-1]['changed_at'], rows[-1]['user_id'])
+
+SQLITE_STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS registered_users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    registered_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_registered_users_page ON registered_users (registered_at DESC, user_id DESC);
+
+CREATE TABLE IF NOT EXISTS direct_message_users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    registered_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_direct_message_users_page ON direct_message_users (registered_at DESC, user_id DESC);
+
+CREATE TABLE IF NOT EXISTS user_registration_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    action TEXT,
+    details TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_registration_log_page ON user_registration_log (timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_user_registration_log_user ON user_registration_log (user_id, timestamp DESC, id DESC);
+
+CREATE TABLE IF NOT EXISTS user_registration_log_daily (
+    day TEXT NOT NULL,
+    action TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, action)
+);
+"""
+
+class SQLiteStorage(StorageBackend):
+    """Almacenamiento local en SQLite (modo WAL), sin viajes de red
+
+    Todas las consultas son parametrizadas con SQL fijo, así sqlite3 reutiliza
+    las sentencias preparadas de su caché por conexión. Los timestamps se
+    guardan en UTC con ancho fijo para ordenarlos y compararlos como texto.
+    """
+    name = 'SQLite'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_STORAGE_SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """Transacción de escritura (BEGIN IMMEDIATE) con la conexión bloqueada
+
+        Dentro de otra transacción del mismo hilo se une a ella.
+        """
+        with self.lock:
+            if self.conn.in_transaction:
+                yield self.conn
+                return
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def query(self, sql, params=()):
+        """Ejecuta una consulta de lectura y devuelve las filas como dicts"""
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params)]
+
+    @staticmethod
+    def user_table(table):
+        # Los nombres de tabla no se pueden parametrizar: solo se aceptan los conocidos
+        if table not in USER_TABLES:
+            raise ValueError(f"Tabla de usuarios desconocida: {table}")
+        return table
+
+    def check(self):
+        self.query("SELECT 1 FROM registered_users LIMIT 1")
+        self.query("SELECT 1 FROM user_registration_log LIMIT 1")
+
+    def backup(self):
+        backup_path = f"{self.path}.bak"
+        with self.lock:
+            target = sqlite3.connect(backup_path)
+            try:
+                self.conn.backup(target)
+            finally:
+                target.close()
+        logging.info(f"✅ Respaldo SQLite creado en {backup_path}")
+        return True
+
+    def load_user_ids(self, table):
+        with self.lock:
+            return {row[0] for row in self.conn.execute(f"SELECT user_id FROM {self.user_table(table)}")}
+
+    def get_user(self, table, user_id):
+        rows = self.query(f"SELECT {USER_LIST_COLUMNS} FROM {self.user_table(table)} WHERE user_id = ?", (user_id,))
+        return rows[0] if rows else None
+
+    def insert_log(self, conn, user_id, action, details):
+        conn.execute(
+            "INSERT INTO user_registration_log (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
+            (user_id, action, details, utc_timestamp())
+        )
+
+    def upsert_registered_user(self, user_id, username, first_name, last_name, is_new_user=None):
+        # La misma transacción sabe si es nuevo: la indicación no hace falta
+        with self.transaction() as conn:
+            is_new_user = conn.execute("SELECT 1 FROM registered_users WHERE user_id = ?", (user_id,)).fetchone() is None
+            conn.execute(
+                "INSERT INTO registered_users (user_id, username, first_name, last_name, registered_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name",
+                (user_id, username, first_name, last_name, utc_timestamp())
+            )
+            action = "REGISTRO" if is_new_user else "ACTUALIZACION"
+            self.insert_log(conn, user_id, action, user_log_details(username, first_name, last_name))
+        return is_new_user
+
+    def insert_direct_message_user(self, user_id, username, first_name, last_name):
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO direct_message_users (user_id, username, first_name, last_name, registered_at) VALUES (?, ?, ?, ?, ?)",
+                (user_id, username, first_name, last_name, utc_timestamp())
+            )
+            is_new_user = cursor.rowcount == 1
+            if is_new_user:
+                self.insert_log(conn, user_id, "REGISTRO_DIRECT_MESSAGE", user_log_details(username, first_name, last_name))
+        return is_new_user
+
+    def delete_users(self, table, user_ids):
+        table = self.user_table(table)
+        deleted = []
+        with self.transaction() as conn:
+            for chunk in chunked(list(user_ids), 500):
+                placeholders = ','.join('?' * len(chunk))
+                deleted.extend(dict(row) for row in conn.execute(f"SELECT {USER_LIST_COLUMNS} FROM {table} WHERE user_id IN ({placeholders})", chunk))
+                conn.execute(f"DELETE FROM {table} WHERE user_id IN ({placeholders})", chunk)
+        return deleted
+
+    def insert_logs(self, rows):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO user_registration_log (user_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
+                [(row['user_id'], row['action'], row.get('details'), utc_timestamp(row.get('timestamp'))) for row in rows]
+            )
+
+    def fetch_user_rows(self, table, cursor, limit):
+        table = self.user_table(table)
+        if not cursor:
+            return self.query(f"SELECT {USER_LIST_COLUMNS} FROM {table} ORDER BY registered_at DESC, user_id DESC LIMIT ?", (limit,))
+        registered_at, user_id = cursor
+        return self.query(
+            f"SELECT {USER_LIST_COLUMNS} FROM {table} WHERE registered_at < ? OR (registered_at = ? AND user_id < ?) "
+            f"ORDER BY registered_at DESC, user_id DESC LIMIT ?",
+            (registered_at, registered_at, user_id, limit)
+        )
+
+    def fetch_log_rows(self, filters, cursor, limit):
+        conditions = []
+        params = []
+        if 'user_id' in filters:
+            conditions.append("user_id = ?")
+            params.append(filters['user_id'])
+        if 'action' in filters:
+            conditions.append("action = ?")
+            params.append(filters['action'])
+        if 'since' in filters:
+            conditions.append("timestamp >= ?")
+            params.append(utc_timestamp(filters['since']))
+        if 'until' in filters:
+            conditions.append("timestamp < ?")
+            params.append(utc_timestamp(filters['until']))
+        if cursor:
+            timestamp, log_id = cursor
+            conditions.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params.extend([timestamp, timestamp, log_id])
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        return self.query(
+            f"SELECT {LOG_COLUMNS} FROM user_registration_log {where}ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*params, limit)
+        )
+
+    def fetch_logs_before(self, cutoff, limit):
+        return self.query(
+            f"SELECT {LOG_COLUMNS} FROM user_registration_log WHERE timestamp < ? ORDER BY id LIMIT ?",
+            (utc_timestamp(cutoff), limit)
+        )
+
+    def expire_logs(self, log_ids):
+        expired = 0
+        with self.transaction() as conn:
+            for chunk in chunked(list(log_ids), 500):
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT timestamp, action FROM user_registration_log WHERE id IN ({placeholders})", chunk
+                ).fetchall()
+                counts = Counter((row['timestamp'][:10], row['action'] or '') for row in rows)
+                conn.executemany(
+                    "INSERT INTO user_registration_log_daily (day, action, count) VALUES (?, ?, ?) "
+                    "ON CONFLICT (day, action) DO UPDATE SET count = count + excluded.count",
+                    [(day, action, count) for (day, action), count in counts.items()]
+                )
+                conn.execute(f"DELETE FROM user_registration_log WHERE id IN ({placeholders})", chunk)
+                expired += len(rows)
+        return expired
+
+class MemoryStorage(SQLiteStorage):
+    """Almacenamiento en memoria (SQLite :memory:), para pruebas y benchmarks; se pierde al reiniciar"""
+    name = 'memoria'
+
+    def __init__(self):
+        super().__init__(':memory:')
+
+    def backup(self):
+        logging.warning("⚠️ El almacenamiento en memoria no tiene respaldo")
+        return False
+
+# Mismo cuerpo que la función expire_logs de SUPABASE_SETUP.md: solo se cuentan las filas
+# que este DELETE borró (si otra instancia ya las borró no suman), y el CTE del resumen
+# corre aunque no se lo use en el SELECT
+EXPIRE_LOGS_SQL = """
+WITH moved AS (
+    DELETE FROM user_registration_log WHERE id = ANY(%s)
+    RETURNING action, timestamp
+), counted AS (
+    INSERT INTO user_registration_log_daily (day, action, count)
+    SELECT (timestamp AT TIME ZONE 'UTC')::date, COALESCE(action, ''), count(*) FROM moved GROUP BY 1, 2
+    ON CONFLICT (day, action) DO UPDATE SET count = user_registration_log_daily.count + EXCLUDED.count
+)
+SELECT count(*) FROM moved
+"""
+
+class PostgresStorage(StorageBackend):
+    """Almacenamiento directo en el Postgres de Supabase con un pool de conexiones psycopg2
+
+    Las consultas frecuentes (registro, borrado, log, consulta de usuario) se
+    preparan en el servidor una vez por conexión (PREPARE) y luego solo se
+    ejecutan (EXECUTE). Registro y log van en una misma transacción.
+    """
+    name = 'Postgres'
+
+    def __init__(self, dsn, minconn, maxconn):
+        import psycopg2
+        import psycopg2.pool
+        self.psycopg2 = psycopg2
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        # El pool se crea en el primer uso: si la base no responde al iniciar, se reintenta después
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # getconn() lanza PoolError con el pool agotado: el semáforo hace esperar al hilo hasta que se libere una
+        self.pool_slots = threading.BoundedSemaphore(maxconn)
+        # id(conexión) -> (conexión, nombres ya preparados en esa sesión)
+        self.prepared = {}
+        self.prepared_lock = threading.Lock()
+        self.statements = {
+            'upsert_registered_user': (
+                "bigint, text, text, text",
+                "INSERT INTO registered_users (user_id, username, first_name, last_name) VALUES ($1, $2, $3, $4) "
+                "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name "
+                "RETURNING (xmax = 0)"
+            ),
+            'insert_direct_message_user': (
+                "bigint, text, text, text",
+                "INSERT INTO direct_message_users (user_id, username, first_name, last_name) VALUES ($1, $2, $3, $4) "
+                "ON CONFLICT (user_id) DO NOTHING RETURNING user_id"
+            ),
+            'insert_log': (
+                "bigint, text, text",
+                "INSERT INTO user_registration_log (user_id, action, details) VALUES ($1, $2, $3)"
+            ),
+            'insert_logs': (
+                "bigint[], text[], text[], timestamptz[]",
+                "INSERT INTO user_registration_log (user_id, action, details, timestamp) SELECT * FROM unnest($1, $2, $3, $4)"
+            ),
+        }
+        for table in USER_TABLES:
+            self.statements[f'get_{table}'] = (
+                "bigint",
+                f"SELECT {USER_LIST_COLUMNS} FROM {table} WHERE user_id = $1"
+            )
+            self.statements[f'get_many_{table}'] = (
+                "bigint[]",
+                f"SELECT {USER_LIST_COLUMNS} FROM {table} WHERE user_id = ANY($1)"
+            )
+            self.statements[f'delete_{table}'] = (
+                "bigint[]",
+                f"DELETE FROM {table} WHERE user_id = ANY($1) RETURNING {USER_LIST_COLUMNS}"
+            )
+            self.statements[f'first_page_{table}'] = (
+                "int",
+                f"SELECT {USER_LIST_COLUMNS} FROM {table} ORDER BY registered_at DESC, user_id DESC LIMIT $1"
+            )
+            self.statements[f'next_page_{table}'] = (
+                "timestamptz, bigint, int",
+                f"SELECT {USER_LIST_COLUMNS} FROM {table} WHERE (registered_at, user_id) < ($1, $2) "
+                f"ORDER BY registered_at DESC, user_id DESC LIMIT $3"
+            )
+
+    @contextmanager
+    def transaction(self):
+        """Cursor sobre una conexión del pool dentro de una transacción (COMMIT al salir, ROLLBACK si falla)"""
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = self.psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+        with self.pool_slots:
+            conn = self.pool.getconn()
+            broken = False
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        yield cur
+            except (self.psycopg2.OperationalError, self.psycopg2.InterfaceError):
+                broken = True
+                raise
+            except self.psycopg2.Error as e:
+                # 26000: la sentencia preparada no existe en la sesión. Las demás sí siguen
+                # preparadas en el servidor (un PREPARE nuevo daría 42P05): se descarta la conexión
+                if e.pgcode == '26000':
+                    broken = True
+                raise
+            finally:
+                broken = broken or bool(conn.closed)
+                if broken:
+                    self.forget_prepared(conn)
+                self.pool.putconn(conn, close=broken)
+
+    def forget_prepared(self, conn):
+        with self.prepared_lock:
+            self.prepared.pop(id(conn), None)
+
+    def execute(self, cur, name, params):
+        """Ejecuta una sentencia preparada, preparándola si es la primera vez en esta conexión"""
+        conn = cur.connection
+        with self.prepared_lock:
+            # Guardar la conexión junto a sus nombres evita que otro objeto reutilice el mismo id
+            prepared = self.prepared.setdefault(id(conn), (conn, set()))[1]
+        if name not in prepared:
+            arg_types, sql = self.statements[name]
+            cur.execute(f"PREPARE {name} ({arg_types}) AS {sql}")
+            prepared.add(name)
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+    @staticmethod
+    def fetch_dicts(cur):
+        """Filas del cursor como dicts, con fechas en ISO (igual que PostgREST)"""
+        columns = [column[0] for column in cur.description]
+        return [
+            {column: value.isoformat() if isinstance(value, datetime) else value for column, value in zip(columns, row)}
+            for row in cur.fetchall()
+        ]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+
+    def check(self):
+        with self.transaction() as cur:
+            cur.execute("SELECT 1 FROM registered_users LIMIT 1")
+            cur.execute("SELECT 1 FROM user_registration_log LIMIT 1")
+
+    def backup(self):
+        # La base es la de Supabase, con respaldo automático
+        logging.info("✅ Supabase tiene respaldo automático habilitado")
+        return True
+
+    def load_user_ids(self, table):
+        if table not in USER_TABLES:
+            raise ValueError(f"Tabla de usuarios desconocida: {table}")
+        with self.transaction() as cur:
+            cur.execute(f"SELECT user_id FROM {table}")
+            return {row[0] for row in cur.fetchall()}
+
+    def get_user(self, table, user_id):
+        with self.transaction() as cur:
+            self.execute(cur, f'get_{table}', (user_id,))
+            rows = self.fetch_dicts(cur)
+        return rows[0] if rows else None
+
+    def get_users(self, table, user_ids):
+        with self.transaction() as cur:
+            self.execute(cur, f'get_many_{table}', (list(user_ids),))
+            return self.fetch_dicts(cur)
+
+    def upsert_registered_user(self, user_id, username, first_name, last_name, is_new_user=None):
+        with self.transaction() as cur:
+            self.execute(cur, 'upsert_registered_user', (user_id, username, first_name, last_name))
+            is_new_user = cur.fetchone()[0]
+            action = "REGISTRO" if is_new_user else "ACTUALIZACION"
+            self.execute(cur, 'insert_log', (user_id, action, user_log_details(username, first_name, last_name)))
+        return is_new_user
+
+    def insert_direct_message_user(self, user_id, username, first_name, last_name):
+        with self.transaction() as cur:
+            self.execute(cur, 'insert_direct_message_user', (user_id, username, first_name, last_name))
+            is_new_user = cur.fetchone() is not None
+            if is_new_user:
+                self.execute(cur, 'insert_log', (user_id, "REGISTRO_DIRECT_MESSAGE", user_log_details(username, first_name, last_name)))
+        return is_new_user
+
+    def delete_users(self, table, user_ids):
+        with self.transaction() as cur:
+            self.execute(cur, f'delete_{table}', (list(user_ids),))
+            return self.fetch_dicts(cur)
+
+    def insert_logs(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        # Un solo INSERT con unnest para todo el lote
+        with self.transaction() as cur:
+            self.execute(cur, 'insert_logs', (
+                [row['user_id'] for row in rows],
+                [row['action'] for row in rows],
+                [row.get('details') for row in rows],
+                [datetime.fromisoformat(utc_timestamp(row.get('timestamp'))) for row in rows]
+            ))
+
+    def fetch_user_rows(self, table, cursor, limit):
+        with self.transaction() as cur:
+            if cursor:
+                self.execute(cur, f'next_page_{table}', (*cursor, limit))
+            else:
+                self.execute(cur, f'first_page_{table}', (limit,))
+            return self.fetch_dicts(cur)
+
+    def fetch_log_rows(self, filters, cursor, limit):
+        # Filtros variables: SQL armado según los filtros (parametrizado) para que
+        # el planificador elija el índice adecuado en cada combinación
+        conditions = []
+        params = []
+        if 'user_id' in filters:
+            conditions.append("user_id = %s")
+            params.append(filters['user_id'])
+        if 'action' in filters:
+            conditions.append("action = %s")
+            params.append(filters['action'])
+        if 'since' in filters:
+            conditions.append("timestamp >= %s")
+            params.append(filters['since'])
+        if 'until' in filters:
+            conditions.append("timestamp < %s")
+            params.append(filters['until'])
+        if cursor:
+            conditions.append("(timestamp, id) < (%s::timestamptz, %s)")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        with self.transaction() as cur:
+            cur.execute(
+                f"SELECT {LOG_COLUMNS} FROM user_registration_log {where}ORDER BY timestamp DESC, id DESC LIMIT %s",
+                (*params, limit)
+            )
+            return self.fetch_dicts(cur)
+
+    def fetch_logs_before(self, cutoff, limit):
+        with self.transaction() as cur:
+            cur.execute(
+                f"SELECT {LOG_COLUMNS} FROM user_registration_log WHERE timestamp < %s ORDER BY id LIMIT %s",
+                (cutoff, limit)
+            )
+            rows = self.fetch_dicts(cur)
+        # El archivo se agrupa por día UTC
+        for row in rows:
+            row['timestamp'] = utc_timestamp(row['timestamp'])
+        return rows
+
+    def expire_logs(self, log_ids):
+        with self.transaction() as cur:
+            cur.execute(EXPIRE_LOGS_SQL, (list(log_ids),))
+            return cur.fetchone()[0]
+
+    def fetch_user_changes(self, since):
+        try:
+            with self.transaction() as cur:
+                cur.execute(
+                    "SELECT table_name, user_id, changed_at, deleted FROM user_changes WHERE changed_at > %s ORDER BY changed_at, user_id",
+                    (since,)
+                )
+                return self.fetch_dicts(cur)
+        except self.psycopg2.Error as e:
+            # Sin la vista user_changes (SUPABASE_SETUP.md §11) no hay registro de cambios
+            if e.pgcode in MISSING_RELATION_CODES:
+                raise NotImplementedError("la vista user_changes no existe") from e
+            raise
+
+    def listen_for_changes(self, callback):
+        threading.Thread(target=self.change_listener, args=(callback,), name='postgres-user-changes', daemon=True).start()
+        return True
+
+    def change_listener(self, callback):
+        """Hilo con una conexión propia en LISTEN user_changes (canal de los triggers de SUPABASE_SETUP.md)"""
+        while True:
+            conn = None
+            try:
+                conn = self.psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN user_changes")
+                logging.info("👂 Escuchando cambios de usuarios (LISTEN user_changes)")
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        callback()
+            except Exception as e:
+                logging.warning(f"⚠️ Se perdió la escucha de cambios de usuarios, reintentando: {e}")
+                time.sleep(10)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+# Operaciones del espejo que modifican tablas de usuarios (frenan la copia de cambios remotos)
+MIRROR_USER_OPS = ('upsert_registered_user', 'insert_direct_message_user', 'delete_users')
+
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mirror_ops (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    args TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS mirror_dead_ops (
+    id INTEGER PRIMARY KEY,
+    op TEXT NOT NULL,
+    args TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+class MirroredStorage(StorageBackend):
+    """Copia local (SQLite) de un almacenamiento remoto, tolerante a caídas
+
+    Las escrituras se aplican en la copia local y se anotan en la tabla
+    mirror_ops dentro de la misma transacción; un hilo las reproduce en el
+    remoto, en orden y por lotes, cuando está disponible. Los usuarios se leen
+    de la copia local; el historial y el mantenimiento del log usan el remoto.
+    """
+
+    def __init__(self, remote, path):
+        self.remote = remote
+        self.local = SQLiteStorage(path)
+        self.local.conn.executescript(MIRROR_SCHEMA)
+        # Copias locales creadas antes de los reintentos por operación
+        columns = {row['name'] for row in self.local.query("PRAGMA table_info(mirror_ops)")}
+        if 'attempts' not in columns:
+            self.local.conn.execute("ALTER TABLE mirror_ops ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self.local.conn.execute("ALTER TABLE mirror_ops ADD COLUMN last_error TEXT")
+        self.name = f"{remote.name} (con copia local)"
+        self.remote_available = None
+        self.wakeup = threading.Event()
+
+    def pending_ops(self):
+        return self.local.query("SELECT COUNT(*) AS pending FROM mirror_ops")[0]['pending']
+
+    def has_pending_user_ops(self, conn=None):
+        """Indica si queda alguna escritura de usuarios sin enviar (los logs no cuentan)"""
+        sql = f"SELECT 1 FROM mirror_ops WHERE op IN ({','.join('?' * len(MIRROR_USER_OPS))}) LIMIT 1"
+        if conn is None:
+            return bool(self.local.query(sql, MIRROR_USER_OPS))
+        return conn.execute(sql, MIRROR_USER_OPS).fetchone() is not None
+
+    def record_op(self, conn, op, *args):
+        conn.execute(
+            "INSERT INTO mirror_ops (op, args, created_at) VALUES (?, ?, ?)",
+            (op, json.dumps(args), time.time())
+        )
+
+    def set_remote_available(self, available, error=None):
+        if available and not self.remote_available:
+            logging.info(f"✅ {self.remote.name} disponible, sincronizando la copia local")
+        elif not available and self.remote_available is not False:
+            logging.warning(f"⚠️ {self.remote.name} no disponible, usando la copia local: {error}")
+        self.remote_available = available
+
+    def check(self):
+        self.local.check()
+        try:
+            self.remote.check()
+        except Exception as e:
+            # Sin remoto el bot sigue funcionando con la copia local
+            self.set_remote_available(False, e)
+            return
+        self.set_remote_available(True)
+        if self.pending_ops() == 0:
+            self.refresh_from_remote()
+
+    def refresh_from_remote(self):
+        """Reemplaza los usuarios locales por los del remoto (solo sin operaciones pendientes)"""
+        for table in USER_TABLES:
+            rows = []
+            cursor = None
+            while True:
+                page = self.remote.fetch_user_rows(table, cursor, MIRROR_SYNC_BATCH)
+                rows.extend(page)
+                if len(page) < MIRROR_SYNC_BATCH:
+                    break
+                cursor = (page[-1]['registered_at'], page[-1]['user_id'])
+            with self.local.transaction() as conn:
+                conn.execute(f"DELETE FROM {table}")
+                conn.executemany(
+                    f"INSERT INTO {table} (user_id, username, first_name, last_name, registered_at) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (row['user_id'], row.get('username'), row.get('first_name'), row.get('last_name'), utc_timestamp(row['registered_at']))
+                        for row in rows
+                    ]
+                )
+            logging.info(f"✅ Copia local de {table} actualizada: {len(rows)} usuarios")
+
+    def start(self):
+        threading.Thread(target=self.sync_worker, name='storage-mirror-sync', daemon=True).start()
+
+    def sync_worker(self):
+        """Hilo que reproduce en el remoto las operaciones pendientes"""
+        while True:
+            self.wakeup.wait(MIRROR_SYNC_INTERVAL)
+            self.wakeup.clear()
+            try:
+                replayed = self.replay_ops()
+                self.set_remote_available(True)
+                if replayed:
+                    logging.info(f"🔄 {replayed} operaciones sincronizadas con {self.remote.name}")
+            except Exception as e:
+                self.set_remote_available(False, e)
+
+    def remote_reachable(self):
+        try:
+            self.remote.check()
+            return True
+        except Exception:
+            return False
+
+    def record_op_failure(self, op, error):
+        """Suma un intento a una operación que el remoto rechazó. Devuelve True si pasó a mirror_dead_ops"""
+        attempts = op['attempts'] + 1
+        error = str(error)[:500]
+        with self.local.transaction() as conn:
+            if attempts < MIRROR_MAX_ATTEMPTS:
+                conn.execute("UPDATE mirror_ops SET attempts = ?, last_error = ? WHERE id = ?", (attempts, error, op['id']))
+                return False
+            conn.execute(
+                "INSERT INTO mirror_dead_ops (id, op, args, created_at, attempts, last_error, failed_at) "
+                "SELECT id, op, args, created_at, ?, ?, ? FROM mirror_ops WHERE id = ?",
+                (attempts, error, time.time(), op['id'])
+            )
+            conn.execute("DELETE FROM mirror_ops WHERE id = ?", (op['id'],))
+        logging.error(f"❌ Operación {op['op']} #{op['id']} rechazada {attempts} veces por {self.remote.name}, apartada en mirror_dead_ops: {error}")
+        return True
+
+    def replay_ops(self):
+        """Reproduce las operaciones pendientes en orden
+
+        Si el remoto no responde se detiene en la primera operación con error.
+        Si responde, el error es de esa operación (RLS, restricción): suma un
+        intento y se reintenta en la próxima vuelta; tras MIRROR_MAX_ATTEMPTS
+        pasa a mirror_dead_ops para no frenar la sincronización del resto.
+        """
+        replayed = 0
+        while True:
+            ops = self.local.query("SELECT id, op, args, attempts FROM mirror_ops ORDER BY id LIMIT ?", (MIRROR_SYNC_BATCH,))
+            if not ops:
+                return replayed
+            i = 0
+            isolate = False
+            while i < len(ops):
+                op = ops[i]
+                group = [op]
+                # Los logs seguidos se envían juntos en un solo insert (de a uno si el lote falló)
+                if op['op'] == 'insert_logs' and not isolate:
+                    while i + len(group) < len(ops) and ops[i + len(group)]['op'] == 'insert_logs':
+                        group.append(ops[i + len(group)])
+                try:
+                    if op['op'] == 'insert_logs':
+                        self.remote.insert_logs([row for log_op in group for row in json.loads(log_op['args'])[0]])
+                    else:
+                        getattr(self.remote, op['op'])(*json.loads(op['args']))
+                except Exception as e:
+                    if not self.remote_reachable():
+                        raise
+                    if len(group) > 1:
+                        isolate = True
+                        continue
+                    if not self.record_op_failure(op, e):
+                        logging.warning(f"⚠️ {self.remote.name} rechazó la operación {op['op']} #{op['id']}, se reintentará: {e}")
+                        return replayed
+                    i += 1
+                    continue
+                with self.local.transaction() as conn:
+                    conn.execute(
+                        f"DELETE FROM mirror_ops WHERE id IN ({','.join('?' * len(group))})",
+                        [log_op['id'] for log_op in group]
+                    )
+                replayed += len(group)
+                i += len(group)
+
+    def backup(self):
+        self.local.backup()
+        return self.remote.backup()
+
+    def close(self):
+        self.remote.close()
+
+    def load_user_ids(self, table):
+        return self.local.load_user_ids(table)
+
+    def get_user(self, table, user_id):
+        return self.local.get_user(table, user_id)
+
+    def upsert_registered_user(self, user_id, username, first_name, last_name, is_new_user=None):
+        with self.local.transaction() as conn:
+            is_new_user = self.local.upsert_registered_user(user_id, username, first_name, last_name)
+            # Al reproducirla, el remoto sin función de registro no puede deducir si es nuevo
+            # (un reintento ya encontraría la fila): se envía lo que vio la copia local
+            self.record_op(conn, 'upsert_registered_user', user_id, username, first_name, last_name, is_new_user)
+        self.wakeup.set()
+        return is_new_user
+
+    def insert_direct_message_user(self, user_id, username, first_name, last_name):
+        with self.local.transaction() as conn:
+            is_new_user = self.local.insert_direct_message_user(user_id, username, first_name, last_name)
+            if is_new_user:
+                self.record_op(conn, 'insert_direct_message_user', user_id, username, first_name, last_name)
+        self.wakeup.set()
+        return is_new_user
+
+    def delete_users(self, table, user_ids):
+        user_ids = list(user_ids)
+        with self.local.transaction() as conn:
+            deleted = self.local.delete_users(table, user_ids)
+            self.record_op(conn, 'delete_users', table, user_ids)
+        self.wakeup.set()
+        return deleted
+
+    def insert_logs(self, rows):
+        rows = [dict(row, timestamp=utc_timestamp(row.get('timestamp'))) for row in rows]
+        with self.local.transaction() as conn:
+            self.local.insert_logs(rows)
+            self.record_op(conn, 'insert_logs', rows)
+        self.wakeup.set()
+
+    def fetch_user_rows(self, table, cursor, limit):
+        return self.local.fetch_user_rows(table, cursor, limit)
+
+    def fetch_log_rows(self, filters, cursor, limit):
+        # El historial completo está en el remoto; sin conexión se muestra el local
+        if self.remote_available:
+            try:
+                return self.remote.fetch_log_rows(filters, cursor, limit)
+            except Exception as e:
+                self.set_remote_available(False, e)
+        return self.local.fetch_log_rows(filters, cursor, limit)
+
+    def fetch_logs_before(self, cutoff, limit):
+        # Los logs locales ya sincronizados con más antigüedad que la retención se descartan
+        with self.local.transaction() as conn:
+            conn.execute("DELETE FROM user_registration_log WHERE timestamp < ?", (utc_timestamp(cutoff),))
+        return self.remote.fetch_logs_before(cutoff, limit)
+
+    def expire_logs(self, log_ids):
+        return self.remote.expire_logs(log_ids)
+
+    def fetch_user_changes(self, since):
+        # Mientras haya escrituras de usuarios sin enviar, el remoto aún no las refleja
+        # (p. ej. una baja): se espera a la próxima vuelta sin avanzar el watermark
+        if self.has_pending_user_ops():
+            return []
+        changes = self.remote.fetch_user_changes(since)
+        if changes and not self.apply_remote_changes(changes):
+            return []
+        return changes
+
+    def apply_remote_changes(self, changes):
+        """Copia a las tablas locales el estado remoto de los usuarios que cambiaron
+
+        /registered, /listamensajes y get_user leen la copia local: sin esto solo
+        verían los cambios de otras instancias al reiniciar. Devuelve False si
+        mientras tanto hubo una escritura local (se reintenta en la próxima vuelta).
+        """
+        changed_ids = {}
+        for change in changes:
+            if change['table_name'] in USER_TABLES:
+                changed_ids.setdefault(change['table_name'], set()).add(change['user_id'])
+        # Se lee el remoto fuera de la transacción local para no frenar los registros
+        remote_rows = {table: self.remote.get_users(table, user_ids) for table, user_ids in changed_ids.items()}
+        with self.local.transaction() as conn:
+            # Una escritura local sin enviar es más nueva que lo leído del remoto
+            if self.has_pending_user_ops(conn):
+                return False
+            for table, rows in remote_rows.items():
+                deleted_ids = changed_ids[table] - {row['user_id'] for row in rows}
+                conn.executemany(f"DELETE FROM {table} WHERE user_id = ?", [(user_id,) for user_id in deleted_ids])
+                conn.executemany(
+                    f"INSERT INTO {table} (user_id, username, first_name, last_name, registered_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name, "
+                    "last_name = excluded.last_name, registered_at = excluded.registered_at",
+                    [
+                        (row['user_id'], row.get('username'), row.get('first_name'), row.get('last_name'), utc_timestamp(row['registered_at']))
+                        for row in rows
+                    ]
+                )
+        return True
+
+    def listen_for_changes(self, callback):
+        return self.remote.listen_for_changes(callback)
+
+def create_storage(backend):
+    """Crea el backend de almacenamiento configurado en STORAGE_BACKEND"""
+    if backend == 'sqlite':
+        return SQLiteStorage(STORAGE_SQLITE_PATH)
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'postgres':
+        remote = PostgresStorage(DATABASE_URL, POSTGRES_POOL_MIN, POSTGRES_POOL_MAX)
+    else:
+        remote = SupabaseStorage(supabase)
+    if STORAGE_MIRROR_PATH:
+        return MirroredStorage(remote, STORAGE_MIRROR_PATH)
+    return remote
+
+storage = create_storage(STORAGE_BACKEND)
+atexit.register(storage.close)
+
+def init_database():
+    """Inicializa la base de datos verificando el almacenamiento configurado"""
+    try:
+        storage.check()
+        logging.info(f"✅ Base de datos {storage.name} inicializada correctamente")
         return True
     except Exception as e:
-        logging.error(f"❌ Error al inicializar base de datos Supabase: {e}")
-        logging.error("💡 Asegúrate de que las tablas estén creadas en Supabase")
+        logging.error(f"❌ Error al inicializar base de datos {storage.name}: {e}")
+        logging.error("💡 Asegúrate de que las tablas estén creadas (ver SUPABASE_SETUP.md)")
         return False
 
 def backup_database():
     """Crea un respaldo de la base de datos (Supabase ya tiene respaldo automático)"""
     try:
-        # Supabase tiene respaldo automático, solo confirmamos
-        logging.info("✅ Supabase tiene respaldo automático habilitado")
-        return True
+        return storage.backup()
     except Exception as e:
         logging.error(f"❌ Error al verificar respaldo: {e}")
         return False
 
+# Buffer de logs pendientes de escribir en user_registration_log
+audit_log_buffer = deque()
+audit_log_condition = threading.Condition()
+audit_spill_lock = threading.Lock()
+
 def log_user_action(user_id, action, details=""):
-    """Registra una acción del usuario en el log usando Supabase"""
-    try:
-        result = supabase.table('user_registration_log').insert({
-            'user_id': user_id,
-            'action': action,
-            'details': details
-        }).execute()
-        
+    """Registra una acción del usuario en el log (escritura diferida)"""
+    log_user_actions([(user_id, action, details)])
+
+def log_user_actions(entries):
+    """Registra varias acciones en el log. entries: [(user_id, action, details)]
+
+    Las filas quedan en un buffer en memoria que un hilo vuelca en la base de
+    datos por lotes, así los comandos no esperan la escritura.
+    """
+    if not entries:
+        return
+    timestamp = datetime.now(pytz.utc).isoformat()
+    rows = [
+        {'user_id': user_id, 'action': action, 'details': details, 'timestamp': timestamp}
+        for user_id, action, details in entries
+    ]
+    overflow = []
+    with audit_log_condition:
+        for row in rows:
+            if len(audit_log_buffer) < AUDIT_BUFFER_MAX_ROWS:
+                audit_log_buffer.append(row)
+            else:
+                overflow.append(row)
+        if len(audit_log_buffer) >= AUDIT_FLUSH_MAX_ROWS:
+            audit_log_condition.notify()
+    if overflow:
+        logging.warning(f"⚠️ Buffer de logs lleno, {len(overflow)} logs enviados al archivo local")
+        spill_audit_rows(overflow)
+    for user_id, action, _ in entries:
         logging.info(f"📝 Log registrado: Usuario {user_id} - {action}")
-        
+
+def spill_audit_rows(rows):
+    """Guarda logs en el archivo local para reintentarlos más tarde"""
+    try:
+        with audit_spill_lock:
+            with open(AUDIT_SPILL_PATH, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
     except Exception as e:
-        logging.error(f"❌ Error al registrar log: {e}")
+        logging.error(f"❌ Error al guardar logs en archivo local ({len(rows)} perdidos): {e}")
+
+def replay_spilled_audit_rows():
+    """Reintenta los logs guardados en el archivo local"""
+    with audit_spill_lock:
+        if not os.path.exists(AUDIT_SPILL_PATH) or os.path.getsize(AUDIT_SPILL_PATH) == 0:
+            return
+        with open(AUDIT_SPILL_PATH, 'r', encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        storage.insert_logs(rows)
+        os.remove(AUDIT_SPILL_PATH)
+    logging.info(f"✅ {len(rows)} logs del archivo local escritos en la base de datos")
+
+def flush_audit_log():
+    """Vuelca el buffer de logs en la base de datos por lotes; si falla, los pasa al archivo local"""
+    while True:
+        with audit_log_condition:
+            batch = [audit_log_buffer.popleft() for _ in range(min(len(audit_log_buffer), AUDIT_FLUSH_MAX_ROWS))]
+        if not batch:
+            return
+        try:
+            storage.insert_logs(batch)
+        except Exception as e:
+            logging.error(f"❌ Error al registrar {len(batch)} logs, guardándolos en archivo local: {e}")
+            spill_audit_rows(batch)
+            with audit_log_condition:
+                rest = list(audit_log_buffer)
+                audit_log_buffer.clear()
+            spill_audit_rows(rest)
+            return
+
+def audit_log_flusher():
+    """Hilo que vuelca el buffer de logs cada AUDIT_FLUSH_INTERVAL_MS o al llegar a AUDIT_FLUSH_MAX_ROWS"""
+    while True:
+        with audit_log_condition:
+            audit_log_condition.wait(AUDIT_FLUSH_INTERVAL_MS / 1000)
+        flush_audit_log()
+        try:
+            replay_spilled_audit_rows()
+        except Exception as e:
+            logging.warning(f"⚠️ No se pudieron reintentar los logs del archivo local: {e}")
+
+def archive_log_rows(rows):
+    """Agrega las filas a los archivos JSONL comprimidos del día (LOG_ARCHIVE_DIR)
+    y las baja a disco (fsync) antes de volver"""
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    rows_by_day = {}
+    for row in rows:
+        rows_by_day.setdefault(row['timestamp'][:10], []).append(row)
+    for day, day_rows in rows_by_day.items():
+        # Cada escritura agrega un miembro gzip; zcat y gzip.open leen el archivo completo
+        path = os.path.join(LOG_ARCHIVE_DIR, f"user_registration_log-{day}.jsonl.gz")
+        with open(path, 'ab') as raw:
+            with gzip.open(raw, 'wt', encoding='utf-8') as f:
+                for row in day_rows:
+                    f.write(json.dumps(row) + "\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+
+def run_log_maintenance():
+    """Archiva, resume y borra las filas del log más antiguas que LOG_RETENTION_DAYS
+
+    Cada lote se escribe en el archivo (con fsync) antes de tocar la tabla, así
+    ninguna fila se borra sin quedar guardada; después el resumen diario y el
+    borrado de esos ids son una sola transacción, así un fallo o dos instancias
+    a la vez no cuentan dos veces la misma fila. Tras una caída entre ambos pasos
+    el archivo puede repetir líneas (se filtran por id), pero no perderlas.
+    Devuelve la cantidad de filas borradas.
+    """
+    cutoff = (datetime.now(pytz.utc) - timedelta(days=LOG_RETENTION_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0)
+    processed = 0
+    while True:
+        rows = storage.fetch_logs_before(cutoff.isoformat(), LOG_MAINTENANCE_BATCH)
+        if not rows:
+            break
+        # Si el archivo falla, la excepción corta el mantenimiento y las filas quedan en la tabla
+        archive_log_rows(rows)
+        processed += storage.expire_logs([row['id'] for row in rows])
+        if len(rows) < LOG_MAINTENANCE_BATCH:
+            break
+    return processed
+
+def log_maintenance_worker():
+    """Hilo que ejecuta el mantenimiento del log cada LOG_MAINTENANCE_INTERVAL segundos"""
+    while True:
+        try:
+            start = time.time()
+            processed = run_log_maintenance()
+            if processed:
+                logging.info(f"🗜️ Mantenimiento del log: {processed} filas resumidas y archivadas en {time.time() - start:.1f}s")
+        except Exception as e:
+            logging.error(f"❌ Error en el mantenimiento del log: {e}")
+        time.sleep(LOG_MAINTENANCE_INTERVAL)
 
 def load_registered_users():
-    """Carga los usuarios registrados desde Supabase"""
+    """Carga los usuarios registrados desde la base de datos (None si falla)"""
     try:
-        result = supabase.table('registered_users').select('user_id').execute()
-        user_ids = [row['user_id'] for row in result.data]
-        return set(user_ids)
+        return storage.load_user_ids('registered_users')
     except Exception as e:
         logging.error(f"❌ Error al cargar usuarios registrados: {e}")
-        return set()
+        return None
 
 def add_registered_user(user_id, username=None, first_name=None, last_name=None):
-    """Agrega un usuario a la base de datos usando Supabase"""
+    """Agrega o actualiza un usuario en un solo viaje (upsert + log)"""
     try:
-        # Verificar si el usuario ya existe
-        existing = supabase.table('registered_users').select('user_id').eq('user_id', user_id).execute()
-        is_new_user = len(existing.data) == 0
-        
-        # Insertar o actualizar usuario
-        user_data = {
-            'user_id': user_id,
-            'username': username,
-            'first_name': first_name,
-            'last_name': last_name
-        }
-        
-        if is_new_user:
-            result = supabase.table('registered_users').insert(user_data).execute()
-        else:
-            result = supabase.table('registered_users').update(user_data).eq('user_id', user_id).execute()
-        
-        action = "REGISTRO" if is_new_user else "ACTUALIZACION"
-        details = f"Username: {username}, Nombre: {first_name} {last_name}"
-        log_user_action(user_id, action, details)
-        
-        logging.info(f"✅ Usuario {user_id} {'registrado' if is_new_user else 'actualizado'} en Supabase")
+        is_new_user = storage.upsert_registered_user(user_id, username, first_name, last_name)
+        logging.info(f"✅ Usuario {user_id} {'registrado' if is_new_user else 'actualizado'} en {storage.name}")
         return True
     except Exception as e:
         logging.error(f"❌ Error al agregar usuario {user_id}: {e}")
         return False
 
 def remove_registered_user(user_id):
-    """Remueve un usuario de la base de datos usando Supabase"""
+    """Remueve un usuario de la base de datos"""
     try:
-        # Obtener información del usuario antes de eliminarlo
-        user_info = supabase.table('registered_users').select('username, first_name, last_name').eq('user_id', user_id).execute()
-        
-        # Eliminar usuario
-        result = supabase.table('registered_users').delete().eq('user_id', user_id).execute()
-        
-        # Registrar la acción en el log
-        if user_info.data:
-            user_data = user_info.data[0]
-            details = f"Username: {user_data.get('username')}, Nombre: {user_data.get('first_name')} {user_data.get('last_name')}"
+        # El borrado devuelve los datos del usuario para el log
+        for user_data in storage.delete_users('registered_users', [user_id]):
+            details = user_log_details(user_data.get('username'), user_data.get('first_name'), user_data.get('last_name'))
             log_user_action(user_id, "ELIMINACION", details)
         
-        logging.info(f"✅ Usuario {user_id} removido de Supabase")
+        logging.info(f"✅ Usuario {user_id} removido de {storage.name}")
         return True
     except Exception as e:
         logging.error(f"❌ Error al remover usuario {user_id}: {e}")
         return False
 
 def get_user_info(user_id):
-    """Obtiene información de un usuario registrado desde Supabase"""
+    """Obtiene información de un usuario registrado"""
     try:
-        result = supabase.table('registered_users').select('username, first_name, last_name, registered_at').eq('user_id', user_id).execute()
+        user_data = storage.get_user('registered_users', user_id)
         
-        if result.data:
-            user_data = result.data[0]
+        if user_data:
             return {
                 'username': user_data.get('username'),
                 'first_name': user_data.get('first_name'),
@@ -195,110 +1547,922 @@ def get_user_info(user_id):
         logging.error(f"❌ Error al obtener información del usuario {user_id}: {e}")
         return None
 
-def load_direct_message_users():
-    """Carga los usuarios registrados para mensajes directos desde Supabase"""
+def load_direct_message_users():
+    """Carga los usuarios registrados para mensajes directos desde la base de datos (None si falla)"""
+    try:
+        return storage.load_user_ids('direct_message_users')
+    except Exception as e:
+        logging.error(f"❌ Error al cargar usuarios de mensajes directos: {e}")
+        return None
+
+def load_startup_users():
+    """Carga en paralelo los usuarios registrados y los de mensajes directos
+
+    Devuelve (registrados, mensajes directos, completa); si una tabla falla, su
+    conjunto queda vacío y completa es False.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup-load') as executor:
+        registered_future = executor.submit(load_registered_users)
+        direct_message_future = executor.submit(load_direct_message_users)
+        loaded_registered = registered_future.result()
+        loaded_direct_message = direct_message_future.result()
+    complete = loaded_registered is not None and loaded_direct_message is not None
+    loaded_registered = loaded_registered if loaded_registered is not None else set()
+    loaded_direct_message = loaded_direct_message if loaded_direct_message is not None else set()
+    logging.info(
+        f"👥 Usuarios cargados en {time.time() - start:.2f}s: "
+        f"{len(loaded_registered)} registrados, {len(loaded_direct_message)} de mensajes directos"
+    )
+    return loaded_registered, loaded_direct_message, complete
+
+def add_direct_message_user(user_id, username=None, first_name=None, last_name=None):
+    """Agrega un usuario para recibir mensajes directos en un solo viaje"""
+    try:
+        is_new_user = storage.insert_direct_message_user(user_id, username, first_name, last_name)
+        
+        if is_new_user:
+            logging.info(f"✅ Usuario {user_id} registrado para mensajes directos")
+        else:
+            logging.info(f"ℹ️ Usuario {user_id} ya está registrado para mensajes directos")
+        return True  # Si ya estaba registrado, consideramos éxito
+    except Exception as e:
+        logging.error(f"❌ Error al agregar usuario de mensajes directos {user_id}: {e}")
+        return False
+
+def remove_direct_message_user(user_id):
+    """Remueve un usuario de los mensajes directos"""
+    try:
+        # El borrado devuelve los datos del usuario para el log
+        for user_data in storage.delete_users('direct_message_users', [user_id]):
+            details = user_log_details(user_data.get('username'), user_data.get('first_name'), user_data.get('last_name'))
+            log_user_action(user_id, "ELIMINACION_DIRECT_MESSAGE", details)
+        
+        logging.info(f"✅ Usuario {user_id} removido de mensajes directos")
+        return True
+    except Exception as e:
+        logging.error(f"❌ Error al remover usuario de mensajes directos {user_id}: {e}")
+        return False
+
+# Instantánea binaria de los conjuntos de usuarios:
+# cabecera (magia, versión, watermark en µs UTC, cantidades) + dos arreglos int64 ordenados
+USER_SNAPSHOT_MAGIC = b'BTUS'
+USER_SNAPSHOT_VERSION = 1
+USER_SNAPSHOT_HEADER = struct.Struct('<4sHqQQ')
+UTC_EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+# Último cambio de usuarios aplicado en memoria (timestamp ISO UTC); None si la carga no fue completa
+user_sync_watermark = None
+user_sync_lock = threading.Lock()
+
+def timestamp_to_micros(value):
+    """Timestamp ISO a microsegundos desde 1970 (UTC)"""
+    return (datetime.fromisoformat(utc_timestamp(value)) - UTC_EPOCH) // timedelta(microseconds=1)
+
+def micros_to_timestamp(micros):
+    """Microsegundos desde 1970 (UTC) a timestamp ISO"""
+    return (UTC_EPOCH + timedelta(microseconds=micros)).isoformat(timespec='microseconds')
+
+def save_user_snapshot():
+    """Guarda la instantánea de registered_users y direct_message_users (escritura atómica)"""
+    try:
+        with user_sync_lock:
+            watermark = user_sync_watermark
+            registered = array('q', sorted(registered_users))
+            direct_message = array('q', sorted(direct_message_users))
+        if watermark is None:
+            return
+        # El archivo siempre es little-endian
+        if sys.byteorder != 'little':
+            registered.byteswap()
+            direct_message.byteswap()
+        
+        tmp_path = f"{USER_SNAPSHOT_PATH}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(USER_SNAPSHOT_HEADER.pack(
+                USER_SNAPSHOT_MAGIC, USER_SNAPSHOT_VERSION, timestamp_to_micros(watermark), len(registered), len(direct_message)
+            ))
+            registered.tofile(f)
+            direct_message.tofile(f)
+        os.replace(tmp_path, USER_SNAPSHOT_PATH)
+    except Exception as e:
+        logging.error(f"❌ Error al guardar instantánea de usuarios: {e}")
+
+def load_user_snapshot():
+    """Carga la instantánea con mmap. Devuelve (registrados, mensajes directos, watermark) o None"""
+    try:
+        if not os.path.exists(USER_SNAPSHOT_PATH) or os.path.getsize(USER_SNAPSHOT_PATH) < USER_SNAPSHOT_HEADER.size:
+            return None
+        with open(USER_SNAPSHOT_PATH, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, watermark, registered_count, direct_message_count = USER_SNAPSHOT_HEADER.unpack_from(mm, 0)
+            if magic != USER_SNAPSHOT_MAGIC or version != USER_SNAPSHOT_VERSION:
+                logging.warning("⚠️ Instantánea de usuarios con formato desconocido, se ignora")
+                return None
+            if len(mm) != USER_SNAPSHOT_HEADER.size + 8 * (registered_count + direct_message_count):
+                logging.warning("⚠️ Instantánea de usuarios incompleta, se ignora")
+                return None
+            
+            offset = USER_SNAPSHOT_HEADER.size
+            registered = array('q')
+            registered.frombytes(mm[offset:offset + 8 * registered_count])
+            offset += 8 * registered_count
+            direct_message = array('q')
+            direct_message.frombytes(mm[offset:offset + 8 * direct_message_count])
+        if sys.byteorder != 'little':
+            registered.byteswap()
+            direct_message.byteswap()
+        return set(registered), set(direct_message), micros_to_timestamp(watermark)
+    except Exception as e:
+        logging.error(f"❌ Error al cargar instantánea de usuarios: {e}")
+        return None
+
+def user_snapshot_saver():
+    """Hilo que guarda periódicamente la instantánea de usuarios"""
+    while True:
+        time.sleep(USER_SNAPSHOT_INTERVAL)
+        save_user_snapshot()
+
+def sync_user_changes():
+    """Aplica en memoria los cambios de usuarios posteriores al watermark
+
+    Se piden los cambios con USER_SYNC_CLOCK_MARGIN segundos de solapamiento; como
+    para cada usuario se aplica solo su último cambio, repetir cambios no altera
+    el resultado. Devuelve la cantidad de usuarios agregados o quitados.
+    Lanza NotImplementedError si el almacenamiento no tiene registro de cambios.
+    """
+    global user_sync_watermark
+    watermark = user_sync_watermark
+    since = micros_to_timestamp(timestamp_to_micros(watermark) - USER_SYNC_CLOCK_MARGIN * 1_000_000)
+    
+    latest = {}
+    for change in storage.fetch_user_changes(since):
+        changed_at = utc_timestamp(change['changed_at'])
+        key = (change['table_name'], change['user_id'])
+        if key not in latest or changed_at >= latest[key][0]:
+            latest[key] = (changed_at, change['deleted'])
+        watermark = max(watermark, changed_at)
+    
+    user_sets = {'registered_users': registered_users, 'direct_message_users': direct_message_users}
+    applied = 0
+    with user_sync_lock:
+        for (table, user_id), (_, deleted) in latest.items():
+            target = user_sets.get(table)
+            if target is None:
+                continue
+            if deleted and user_id in target:
+                target.discard(user_id)
+                applied += 1
+            elif not deleted and user_id not in target:
+                target.add(user_id)
+                applied += 1
+        user_sync_watermark = watermark
+    if applied:
+        invalidate_mention_rosters()
+    return applied
+
+def reload_user_sets():
+    """Recarga completa de los conjuntos de usuarios, reemplazando su contenido en el lugar
+
+    Los comandos de este proceso cambian los conjuntos sin tomar user_sync_lock:
+    lo que agregaron o quitaron mientras corría la carga (que puede no reflejarlo)
+    se conserva comparando con una copia tomada al empezar.
+    """
+    global user_sync_watermark
+    started_at = utc_timestamp()
+    before = (set(registered_users), set(direct_message_users))
+    loaded_registered, loaded_direct_message, complete = load_startup_users()
+    if not complete:
+        raise RuntimeError("la carga de usuarios no fue completa")
+    with user_sync_lock:
+        for target, previous, loaded in (
+            (registered_users, before[0], loaded_registered),
+            (direct_message_users, before[1], loaded_direct_message)
+        ):
+            removed_meanwhile = previous - target
+            target.difference_update(previous - loaded)
+            target.update(loaded - removed_meanwhile)
+        user_sync_watermark = started_at
+    invalidate_mention_rosters()
+
+user_sync_wakeup = threading.Event()
+
+def user_sync_worker():
+    """Hilo que aplica cada REPLICA_SYNC_INTERVAL segundos (o al recibir un aviso) los
+    cambios de usuarios hechos por otras instancias del bot"""
+    healthy = True
+    while True:
+        user_sync_wakeup.wait(REPLICA_SYNC_INTERVAL)
+        user_sync_wakeup.clear()
+        try:
+            if user_sync_watermark is None:
+                # La carga inicial falló: se reintenta completa
+                reload_user_sets()
+                logging.info("✅ Usuarios cargados tras un fallo inicial")
+            else:
+                applied = sync_user_changes()
+                if applied:
+                    logging.info(f"🔄 {applied} cambios de usuarios de otras instancias aplicados")
+            if not healthy:
+                logging.info("✅ Sincronización de usuarios restablecida")
+            healthy = True
+        except NotImplementedError:
+            logging.info("ℹ️ El almacenamiento no tiene registro de cambios; sincronización entre instancias desactivada")
+            return
+        except Exception as e:
+            if healthy:
+                logging.warning(f"⚠️ Error al sincronizar usuarios entre instancias: {e}")
+            healthy = False
+
+def start_user_sync():
+    """Inicia la sincronización de usuarios entre instancias (sondeo + avisos si el backend los tiene)"""
+    if REPLICA_SYNC_INTERVAL <= 0:
+        return
+    threading.Thread(target=user_sync_worker, name='user-sync', daemon=True).start()
+    storage.listen_for_changes(user_sync_wakeup.set)
+
+def reconcile_user_sets():
+    """Pone al día los conjuntos cargados de la instantánea (en segundo plano al iniciar)"""
+    try:
+        start = time.time()
+        snapshot_age = timestamp_to_micros(utc_timestamp()) - timestamp_to_micros(user_sync_watermark)
+        # Con una instantánea más vieja que la retención de bajas, los cambios ya no alcanzan
+        if snapshot_age <= USER_TOMBSTONE_RETENTION_DAYS * 86400 * 1_000_000:
+            try:
+                applied = sync_user_changes()
+                logging.info(f"🔄 Instantánea de usuarios reconciliada en {time.time() - start:.2f}s: {applied} cambios")
+                return
+            except NotImplementedError:
+                pass
+        # Sin registro de cambios (o instantánea demasiado vieja): recarga completa
+        reload_user_sets()
+        logging.info(f"🔄 Usuarios recargados por completo en {time.time() - start:.2f}s")
+    except Exception as e:
+        logging.error(f"❌ Error al reconciliar usuarios, se sigue con la instantánea: {e}")
+
+# Bandeja de salida: una fila por (alerta, destinatario). Los workers reclaman
+# lotes con semántica SKIP LOCKED, así varios procesos pueden vaciar la misma
+# difusión en paralelo y retomarla donde quedó tras un reinicio.
+outbox_sqlite_connection = None
+outbox_sqlite_lock = threading.Lock()
+outbox_wakeup = threading.Event()
+
+def get_outbox_sqlite():
+    """Abre (una vez) la base SQLite local de la bandeja de salida"""
+    global outbox_sqlite_connection
+    if outbox_sqlite_connection is None:
+        conn = sqlite3.connect(OUTBOX_SQLITE_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                alert_id TEXT NOT NULL,
+                recipient_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                claimed_at REAL,
+                sent_at REAL,
+                last_error TEXT,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                UNIQUE (alert_id, recipient_id)
+            )
+        """)
+        # Bases creadas antes de los reintentos con espera
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(broadcast_outbox)")}
+        if 'next_attempt_at' not in columns:
+            conn.execute("ALTER TABLE broadcast_outbox ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS broadcast_outbox_status_idx ON broadcast_outbox (status, id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS dm_failure_reports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                failure_class TEXT,
+                reported_at REAL NOT NULL
+            )
+        """)
+        outbox_sqlite_connection = conn
+    return outbox_sqlite_connection
+
+def outbox_enqueue(alert_id, recipient_ids, message_text):
+    """Agrega a la bandeja de salida una fila por destinatario (ignora duplicados)"""
+    if not recipient_ids:
+        return
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            conn = get_outbox_sqlite()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO broadcast_outbox (alert_id, recipient_id, message, created_at) VALUES (?, ?, ?, ?)",
+                    [(alert_id, recipient_id, message_text, now) for recipient_id in recipient_ids]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    else:
+        rows = [{'alert_id': alert_id, 'recipient_id': recipient_id, 'message': message_text} for recipient_id in recipient_ids]
+        for i in range(0, len(rows), 500):
+            supabase.table('broadcast_outbox').upsert(rows[i:i+500], on_conflict='alert_id,recipient_id', ignore_duplicates=True).execute()
+    outbox_wakeup.set()
+
+def outbox_claim(worker_id, batch_size):
+    """Reclama un lote de filas pendientes (o con reclamo vencido) para este worker"""
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            conn = get_outbox_sqlite()
+            now = time.time()
+            # BEGIN IMMEDIATE toma el bloqueo de escritura: otro proceso no puede reclamar las mismas filas
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [row['id'] for row in conn.execute(
+                    "SELECT id FROM broadcast_outbox WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                    "OR (status = 'claimed' AND claimed_at < ?) ORDER BY id LIMIT ?",
+                    (now, now - OUTBOX_CLAIM_TIMEOUT, batch_size)
+                )]
+                rows = []
+                if ids:
+                    placeholders = ','.join('?' * len(ids))
+                    conn.execute(
+                        f"UPDATE broadcast_outbox SET status = 'claimed', claimed_by = ?, claimed_at = ?, attempts = attempts + 1 WHERE id IN ({placeholders})",
+                        [worker_id, now, *ids]
+                    )
+                    rows = [dict(row) for row in conn.execute(f"SELECT * FROM broadcast_outbox WHERE id IN ({placeholders}) ORDER BY id", ids)]
+                conn.execute("COMMIT")
+                return rows
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    result = supabase.rpc('claim_broadcast_outbox', {
+        'p_worker': worker_id,
+        'p_batch_size': batch_size,
+        'p_claim_timeout': OUTBOX_CLAIM_TIMEOUT
+    }).execute()
+    return result.data or []
+
+def outbox_mark_sent(row_ids):
+    """Marca filas como enviadas"""
+    if not row_ids:
+        return
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            placeholders = ','.join('?' * len(row_ids))
+            get_outbox_sqlite().execute(
+                f"UPDATE broadcast_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id IN ({placeholders})",
+                [time.time(), *row_ids]
+            )
+    else:
+        supabase.table('broadcast_outbox').update({
+            'status': 'sent',
+            'sent_at': datetime.now(pytz.utc).isoformat(),
+            'last_error': None
+        }).in_('id', row_ids).execute()
+
+def outbox_retry_delay(attempts):
+    """Segundos de espera antes del próximo intento de una fila con `attempts` intentos"""
+    return min(OUTBOX_RETRY_BASE * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_MAX)
+
+def outbox_mark_failed(row_id, error, retry_in=None):
+    """Marca una fila como fallida, o la devuelve a pendiente para reintentarla en `retry_in` segundos"""
+    status = 'failed' if retry_in is None else 'pending'
+    error = str(error)[:500]
+    next_attempt_at = time.time() + (retry_in or 0)
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            get_outbox_sqlite().execute(
+                "UPDATE broadcast_outbox SET status = ?, claimed_by = NULL, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (status, error, next_attempt_at, row_id)
+            )
+    else:
+        supabase.table('broadcast_outbox').update({
+            'status': status,
+            'claimed_by': None,
+            'last_error': error,
+            'next_attempt_at': datetime.fromtimestamp(next_attempt_at, pytz.utc).isoformat()
+        }).eq('id', row_id).execute()
+
+# Caché negativa: {user_id: {'class', 'failures', 'retry_at'}}
+dm_negative_cache = {}
+dm_negative_cache_lock = threading.Lock()
+dm_negative_cache_dirty = False
+
+def load_dm_negative_cache():
+    """Carga la caché negativa de mensajes directos desde el archivo local"""
     try:
-        result = supabase.table('direct_message_users').select('user_id').execute()
-        user_ids = [row['user_id'] for row in result.data]
-        return set(user_ids)
+        if not os.path.exists(DM_NEGATIVE_CACHE_PATH):
+            return {}
+        with open(DM_NEGATIVE_CACHE_PATH, 'r', encoding='utf-8') as f:
+            cache = {int(user_id): entry for user_id, entry in json.load(f).items()}
+        logging.info(f"✅ Caché negativa de mensajes directos cargada: {len(cache)} usuarios")
+        return cache
     except Exception as e:
-        logging.error(f"❌ Error al cargar usuarios de mensajes directos: {e}")
-        return set()
+        logging.error(f"❌ Error al cargar caché negativa de mensajes directos: {e}")
+        return {}
 
-def add_direct_message_user(user_id, username=None, first_name=None, last_name=None):
-    """Agrega un usuario para recibir mensajes directos usando Supabase"""
+def save_dm_negative_cache(force=False):
+    """Guarda la caché negativa de mensajes directos si hubo cambios"""
+    global dm_negative_cache_dirty
     try:
-        # Verificar si el usuario ya existe
-        existing = supabase.table('direct_message_users').select('user_id').eq('user_id', user_id).execute()
-        is_new_user = len(existing.data) == 0
-        
-        if is_new_user:
-            # Insertar usuario
-            user_data = {
-                'user_id': user_id,
-                'username': username,
-                'first_name': first_name,
-                'last_name': last_name
-            }
-            
-            result = supabase.table('direct_message_users').insert(user_data).execute()
-            
-            action = "REGISTRO_DIRECT_MESSAGE"
-            details = f"Username: {username}, Nombre: {first_name} {last_name}"
-            log_user_action(user_id, action, details)
-            
-            logging.info(f"✅ Usuario {user_id} registrado para mensajes directos")
-            return True
-        else:
-            logging.info(f"ℹ️ Usuario {user_id} ya está registrado para mensajes directos")
-            return True  # Ya está registrado, consideramos éxito
+        with dm_negative_cache_lock:
+            if not dm_negative_cache_dirty and not force:
+                return
+            snapshot = {str(user_id): dict(entry) for user_id, entry in dm_negative_cache.items()}
+            dm_negative_cache_dirty = False
+
+        tmp_path = f"{DM_NEGATIVE_CACHE_PATH}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, DM_NEGATIVE_CACHE_PATH)
     except Exception as e:
-        logging.error(f"❌ Error al agregar usuario de mensajes directos {user_id}: {e}")
-        return False
+        logging.error(f"❌ Error al guardar caché negativa de mensajes directos: {e}")
 
-def remove_direct_message_user(user_id):
-    """Remueve un usuario de los mensajes directos usando Supabase"""
+def dm_negative_cache_saver():
+    """Hilo que persiste periódicamente la caché negativa de mensajes directos"""
+    reports_healthy = True
+    while True:
+        time.sleep(DM_NEGATIVE_CACHE_SAVE_INTERVAL)
+        try:
+            apply_reported_dm_results()
+            reports_healthy = True
+        except Exception as e:
+            if reports_healthy:
+                logging.warning(f"⚠️ No se pudieron aplicar los resultados de los workers de la bandeja de salida: {e}")
+            reports_healthy = False
+        save_dm_negative_cache()
+
+def classify_dm_failure(error):
+    """Tipo de fallo de un mensaje directo para la caché negativa, o None si no aplica"""
+    error_str = str(error).lower()
+    if "bot can't initiate conversation" in error_str:
+        return 'cant_initiate'
+    if isinstance(error, ApiTelegramException):
+        if error.error_code == 403:
+            return 'forbidden'
+        if error.error_code == 400:
+            return 'bad_request'
+    return None
+
+def record_dm_failure(user_id, failure_class):
+    """Suspende los mensajes directos a un usuario con espera exponencial por tipo de fallo"""
+    global dm_negative_cache_dirty
+    with dm_negative_cache_lock:
+        entry = dm_negative_cache.get(user_id)
+        failures = entry['failures'] + 1 if entry and entry['class'] == failure_class else 1
+        interval = min(DM_FAILURE_BASE_INTERVALS[failure_class] * 2 ** (failures - 1), DM_NEGATIVE_CACHE_MAX_INTERVAL)
+        dm_negative_cache[user_id] = {
+            'class': failure_class,
+            'failures': failures,
+            'retry_at': time.time() + interval
+        }
+        dm_negative_cache_dirty = True
+    logging.info(f"🚫 Mensajes directos a {user_id} suspendidos {interval}s ({failure_class}, fallo #{failures})")
+
+def clear_dm_failure(user_id):
+    """Levanta la suspensión de mensajes directos de un usuario"""
+    global dm_negative_cache_dirty
+    with dm_negative_cache_lock:
+        if dm_negative_cache.pop(user_id, None) is None:
+            return
+        dm_negative_cache_dirty = True
+    logging.info(f"✅ Mensajes directos a {user_id} reactivados")
+
+def apply_dm_results(results):
+    """Pasa a la caché negativa los resultados de un lote de mensajes directos
+
+    Un proceso `--outbox-worker` no guarda la caché (es del proceso principal): los
+    anota en la bandeja de salida y el principal los aplica al guardarla.
+    """
+    if OUTBOX_WORKER_MODE:
+        try:
+            outbox_report_dm_results(results)
+        except Exception as e:
+            logging.error(f"❌ Error al anotar {len(results)} resultados de mensajes directos: {e}")
+        return
+    for user_id, failure_class in results:
+        if failure_class:
+            record_dm_failure(user_id, failure_class)
+        else:
+            clear_dm_failure(user_id)
+
+def apply_reported_dm_results(batch_size=500):
+    """Aplica a la caché negativa los resultados anotados por los procesos `--outbox-worker`"""
+    applied = 0
+    while True:
+        reports = outbox_take_dm_reports(batch_size)
+        if not reports:
+            return applied
+        for report in reports:
+            if report['failure_class']:
+                record_dm_failure(report['user_id'], report['failure_class'])
+            else:
+                clear_dm_failure(report['user_id'])
+        outbox_delete_dm_reports(reports[-1]['id'])
+        applied += len(reports)
+        if len(reports) < batch_size:
+            return applied
+
+def is_dm_suppressed(user_id, now=None):
+    """Indica si un usuario está en la caché negativa y aún no toca volver a probar"""
+    entry = dm_negative_cache.get(user_id)
+    return entry is not None and entry['retry_at'] > (now or time.time())
+
+def remove_direct_message_users_bulk(user_ids):
+    """Remueve varios usuarios de los mensajes directos con un solo DELETE y un solo insert de log"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return True
     try:
-        # Obtener información del usuario antes de eliminarlo
-        user_info = supabase.table('direct_message_users').select('username, first_name, last_name').eq('user_id', user_id).execute()
-        
-        # Eliminar usuario
-        result = supabase.table('direct_message_users').delete().eq('user_id', user_id).execute()
-        
-        # Registrar la acción en el log
-        if user_info.data:
-            user_data = user_info.data[0]
-            details = f"Username: {user_data.get('username')}, Nombre: {user_data.get('first_name')} {user_data.get('last_name')}"
-            log_user_action(user_id, "ELIMINACION_DIRECT_MESSAGE", details)
+        # El borrado devuelve las filas eliminadas, con sus datos para el log
+        log_user_actions([
+            (
+                user_data.get('user_id'),
+                "ELIMINACION_DIRECT_MESSAGE",
+                user_log_details(user_data.get('username'), user_data.get('first_name'), user_data.get('last_name'))
+            )
+            for user_data in storage.delete_users('direct_message_users', user_ids)
+        ])
         
-        logging.info(f"✅ Usuario {user_id} removido de mensajes directos")
+        logging.info(f"✅ {len(user_ids)} usuarios removidos de mensajes directos")
         return True
     except Exception as e:
-        logging.error(f"❌ Error al remover usuario de mensajes directos {user_id}: {e}")
+        logging.error(f"❌ Error al remover usuarios de mensajes directos {user_ids}: {e}")
         return False
 
-def send_direct_messages_to_users(alert_text, command_name):
-    """Envía mensajes directos a todos los usuarios registrados"""
+def send_direct_messages_to_users(alert_text, command_name, job_id=None):
+    """Encola mensajes directos para todos los usuarios registrados.
+
+    Las filas quedan en la bandeja de salida y los workers las entregan; si se
+    indica job_id, se usa como ID de la alerta y su progreso se refleja en
+    broadcast_jobs. Devuelve la cantidad de destinatarios encolados.
+    """
     try:
-        if not direct_message_users:
+        # Omitir a quienes hoy no pueden recibir mensajes directos (caché negativa)
+        now = time.time()
+        recipients = [user_id for user_id in list(direct_message_users) if not is_dm_suppressed(user_id, now)]
+        skipped = len(direct_message_users) - len(recipients)
+        if skipped > 0:
+            logging.info(f"⏭️ {skipped} destinatarios omitidos por caché negativa")
+        update_broadcast_job(job_id, total=len(recipients), pending=len(recipients), skipped=max(0, skipped))
+        if not recipients:
             logging.info("ℹ️ No hay usuarios registrados para mensajes directos")
-            return
+            update_broadcast_job(job_id, status='done', finished_at=time.time())
+            return 0
         
         message_text = f"🔔 ALERTA EN EL GRUPO 🔔\n\n"
         message_text += f"Comando: {command_name}\n"
         message_text += f"Mensaje: {alert_text}\n\n"
         message_text += "Favor revisar el grupo para más detalles."
         
-        sent_count = 0
-        for user_id in direct_message_users:
-            try:
-                bot.send_message(user_id, message_text)
-                sent_count += 1
-                logging.info(f"✅ Mensaje directo enviado a usuario {user_id}")
-            except Exception as e:
-                error_str = str(e).lower()
-                logging.error(f"❌ Error al enviar mensaje directo a usuario {user_id}: {e}")
-                
-                # Manejar diferentes tipos de errores
-                if ("chat not found" in error_str or 
-                    "blocked" in error_str or 
-                    "user is deactivated" in error_str):
-                    # Usuario no contactable, removerlo
-                    logging.info(f"🗑️ Removiendo usuario {user_id} de mensajes directos (no contactable)")
-                    remove_direct_message_user(user_id)
-                    direct_message_users.discard(user_id)
-                elif "bot can't initiate conversation" in error_str:
-                    # Usuario no ha iniciado conversación con el bot
-                    logging.warning(f"⚠️ Usuario {user_id} no ha iniciado conversación con el bot")
-                    # No removerlo, solo avisar
-                else:
-                    # Otro tipo de error, no remover
-                    logging.warning(f"⚠️ Error desconocido para usuario {user_id}: {e}")
-        
-        logging.info(f"📤 Mensajes directos enviados: {sent_count}/{len(direct_message_users)}")
+        alert_id = job_id or uuid.uuid4().hex[:8]
+        outbox_enqueue(alert_id, recipients, message_text)
+        # Desde acá el progreso se lee de la bandeja de salida (ver with_outbox_progress)
+        update_broadcast_job(job_id, status='running')
+        logging.info(f"📥 Difusión {alert_id}: {len(recipients)} mensajes directos en la bandeja de salida")
+        return len(recipients)
         
     except Exception as e:
-        logging.error(f"❌ Error al enviar mensajes directos: {e}")
+        logging.error(f"❌ Error al encolar mensajes directos: {e}")
+        update_broadcast_job(job_id, status='failed', error=str(e))
+        return 0
+
+def deliver_outbox_batch(rows):
+    """Envía un lote reclamado de la bandeja de salida y registra el resultado de cada fila"""
+    # Los mensajes directos van con prioridad baja: las respuestas en grupos salen antes
+    futures = {
+        schedule_send(
+            row['recipient_id'],
+            lambda row=row: bot.send_message(row['recipient_id'], row['message']),
+            priority=PRIORITY_BROADCAST
+        ): row
+        for row in rows
+    }
+    
+    sent_ids = []
+    unreachable_ids = []
+    dm_results = []
+    for future in as_completed(futures):
+        row = futures[future]
+        user_id = row['recipient_id']
+        try:
+            future.result()
+            sent_ids.append(row['id'])
+            dm_results.append((user_id, None))
+            logging.info(f"✅ Mensaje directo enviado a usuario {user_id}")
+        except Exception as e:
+            error_str = str(e).lower()
+            logging.error(f"❌ Error al enviar mensaje directo a usuario {user_id}: {e}")
+            
+            # Manejar diferentes tipos de errores
+            retry_in = None
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                # 429 que agotó los reintentos del planificador: no es culpa del mensaje,
+                # vuelve a pendiente sin contar contra OUTBOX_MAX_ATTEMPTS y no antes de retry_after
+                logging.warning(f"⏳ Límite de Telegram para usuario {user_id}, reintento en {retry_after}s o más")
+                retry_in = max(outbox_retry_delay(row['attempts']), retry_after)
+            elif ("chat not found" in error_str or 
+                "blocked" in error_str or 
+                "user is deactivated" in error_str):
+                # Usuario no contactable: se deja de enviarle ya y se remueve al final del lote
+                logging.info(f"🗑️ Removiendo usuario {user_id} de mensajes directos (no contactable)")
+                direct_message_users.discard(user_id)
+                unreachable_ids.append(user_id)
+            elif "bot can't initiate conversation" in error_str:
+                # Usuario no ha iniciado conversación con el bot
+                logging.warning(f"⚠️ Usuario {user_id} no ha iniciado conversación con el bot")
+                # No removerlo: se omite hasta que escriba al bot o toque volver a probar
+                dm_results.append((user_id, 'cant_initiate'))
+            else:
+                # Otro tipo de error, no remover; reintentar si no es un rechazo de Telegram
+                logging.warning(f"⚠️ Error desconocido para usuario {user_id}: {e}")
+                if not isinstance(e, ApiTelegramException) and row['attempts'] < OUTBOX_MAX_ATTEMPTS:
+                    retry_in = outbox_retry_delay(row['attempts'])
+                failure_class = classify_dm_failure(e)
+                if failure_class:
+                    dm_results.append((user_id, failure_class))
+            
+            try:
+                outbox_mark_failed(row['id'], e, retry_in)
+            except Exception as db_error:
+                logging.error(f"❌ Error al actualizar bandeja de salida: {db_error}")
+    
+    outbox_mark_sent(sent_ids)
+    apply_dm_results(dm_results)
+    logging.info(f"📤 Mensajes directos enviados: {len(sent_ids)}/{len(rows)}")
+    
+    # Limpieza en bloque, fuera del ciclo de envío
+    remove_direct_message_users_bulk(unreachable_ids)
+
+def outbox_worker(worker_id):
+    """Worker que vacía la bandeja de salida por lotes"""
+    logging.info(f"📮 Worker de bandeja de salida {worker_id} iniciado")
+    while True:
+        try:
+            rows = outbox_claim(worker_id, OUTBOX_BATCH_SIZE)
+            if rows:
+                deliver_outbox_batch(rows)
+                continue
+        except Exception as e:
+            logging.error(f"❌ Error en worker de bandeja de salida {worker_id}: {e}")
+        outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+        outbox_wakeup.clear()
+
+def start_outbox_workers():
+    """Inicia los workers de la bandeja de salida de este proceso"""
+    threads = []
+    for n in range(OUTBOX_WORKERS):
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-{n}"
+        thread = threading.Thread(target=outbox_worker, args=(worker_id,), name=f'outbox-{n}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+def outbox_prune_sent():
+    """Borra las filas enviadas hace más de OUTBOX_SENT_RETENTION_HOURS. Devuelve cuántas (si se sabe)"""
+    cutoff = time.time() - OUTBOX_SENT_RETENTION_HOURS * 3600
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            return get_outbox_sqlite().execute(
+                "DELETE FROM broadcast_outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,)
+            ).rowcount
+    result = supabase.table('broadcast_outbox').delete().eq('status', 'sent').lt(
+        'sent_at', datetime.fromtimestamp(cutoff, pytz.utc).isoformat()
+    ).execute()
+    return len(result.data or [])
+
+def outbox_alert_counts(alert_ids):
+    """Filas de la bandeja de salida por alerta y estado: {alert_id: {estado: cantidad}}"""
+    alert_ids = list(alert_ids)
+    counts = {alert_id: {} for alert_id in alert_ids}
+    if not alert_ids:
+        return counts
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            rows = [dict(row) for row in get_outbox_sqlite().execute(
+                f"SELECT alert_id, status, COUNT(*) AS count FROM broadcast_outbox "
+                f"WHERE alert_id IN ({','.join('?' * len(alert_ids))}) GROUP BY alert_id, status",
+                alert_ids
+            )]
+    else:
+        rows = supabase.rpc('count_broadcast_outbox', {'p_alert_ids': alert_ids}).execute().data or []
+    for row in rows:
+        counts[row['alert_id']][row['status']] = row['count']
+    return counts
+
+def outbox_report_dm_results(results):
+    """Anota resultados de mensajes directos [(user_id, tipo de fallo o None si se entregó)]
+    para que el proceso principal los pase a su caché negativa"""
+    if not results:
+        return
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            get_outbox_sqlite().executemany(
+                "INSERT INTO dm_failure_reports (user_id, failure_class, reported_at) VALUES (?, ?, ?)",
+                [(user_id, failure_class, time.time()) for user_id, failure_class in results]
+            )
+    else:
+        rows = [{'user_id': user_id, 'failure_class': failure_class} for user_id, failure_class in results]
+        for i in range(0, len(rows), 500):
+            supabase.table('dm_failure_reports').insert(rows[i:i+500]).execute()
+
+def outbox_take_dm_reports(limit):
+    """Lee los resultados anotados por otros procesos, en orden"""
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            return [dict(row) for row in get_outbox_sqlite().execute(
+                "SELECT id, user_id, failure_class FROM dm_failure_reports ORDER BY id LIMIT ?", (limit,)
+            )]
+    return supabase.table('dm_failure_reports').select('id, user_id, failure_class').order('id').limit(limit).execute().data or []
+
+def outbox_delete_dm_reports(last_id):
+    """Borra los resultados ya aplicados (hasta last_id inclusive)"""
+    if OUTBOX_BACKEND == 'sqlite':
+        with outbox_sqlite_lock:
+            get_outbox_sqlite().execute("DELETE FROM dm_failure_reports WHERE id <= ?", (last_id,))
+    else:
+        supabase.table('dm_failure_reports').delete().lte('id', last_id).execute()
+
+def outbox_cleanup_worker():
+    """Hilo que borra las filas enviadas de la bandeja de salida cada OUTBOX_CLEANUP_INTERVAL segundos"""
+    while True:
+        try:
+            deleted = outbox_prune_sent()
+            if deleted:
+                logging.info(f"🧹 Bandeja de salida: {deleted} filas enviadas eliminadas")
+        except Exception as e:
+            logging.error(f"❌ Error al limpiar la bandeja de salida: {e}")
+        time.sleep(OUTBOX_CLEANUP_INTERVAL)
+
+# Trabajos de difusión: {job_id: estado y progreso}, los más recientes al final
+broadcast_jobs = OrderedDict()
+broadcast_jobs_lock = threading.Lock()
+broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix='broadcast')
+
+def update_broadcast_job(job_id, **changes):
+    """Actualiza el estado de un trabajo de difusión (sin efecto si job_id es None)"""
+    if job_id is None:
+        return
+    with broadcast_jobs_lock:
+        job = broadcast_jobs.get(job_id)
+        if job is not None:
+            job.update(changes)
+
+def with_outbox_progress(jobs):
+    """Completa el progreso de los trabajos ya encolados con el estado de sus filas en la
+    bandeja de salida: las entregan los workers de cualquier proceso, no solo de este
+
+    Los enviados se deducen del total (las filas enviadas se borran pasada la retención).
+    """
+    active = [job for job in jobs if job['status'] in ('running', 'done')]
+    if not active:
+        return jobs
+    try:
+        counts = outbox_alert_counts([job['id'] for job in active])
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo leer el progreso de la bandeja de salida: {e}")
+        return jobs
+    for job in active:
+        by_status = counts.get(job['id'], {})
+        failed = by_status.get('failed', 0)
+        pending = by_status.get('pending', 0) + by_status.get('claimed', 0)
+        total = job['total'] or sum(by_status.values())
+        job.update(total=total, failed=failed, pending=pending, sent=max(0, total - pending - failed))
+        if pending == 0 and job['status'] == 'running':
+            job.update(status='done', finished_at=time.time())
+            update_broadcast_job(job['id'], status='done', finished_at=job['finished_at'])
+    return jobs
+
+def get_broadcast_job(job_id):
+    """Devuelve una copia del estado de un trabajo de difusión, o None
+
+    Un ID de otro proceso o de antes de un reinicio se arma con sus filas de la bandeja de salida.
+    """
+    with broadcast_jobs_lock:
+        job = broadcast_jobs.get(job_id)
+        job = dict(job) if job else None
+    if job is None:
+        try:
+            if not outbox_alert_counts([job_id]).get(job_id):
+                return None
+        except Exception as e:
+            logging.warning(f"⚠️ No se pudo buscar la difusión {job_id} en la bandeja de salida: {e}")
+            return None
+        job = {
+            'id': job_id, 'command': '-', 'alert': None, 'status': 'running',
+            'total': 0, 'sent': 0, 'failed': 0, 'pending': 0, 'skipped': 0,
+            'created_at': None, 'started_at': None, 'finished_at': None
+        }
+    return with_outbox_progress([job])[0]
+
+def list_broadcast_jobs():
+    """Devuelve copias de los trabajos de difusión, del más reciente al más antiguo"""
+    with broadcast_jobs_lock:
+        jobs = [dict(job) for job in reversed(broadcast_jobs.values())]
+    return with_outbox_progress(jobs)
+
+def run_broadcast_job(job_id, alert_text, command_name):
+    """Encola en la bandeja de salida los mensajes de un trabajo de difusión"""
+    update_broadcast_job(job_id, started_at=time.time())
+    send_direct_messages_to_users(alert_text, command_name, job_id=job_id)
+
+def register_broadcast_job(alert_text, command_name, status='queued'):
+    """Registra un trabajo de difusión (sin encolarlo) y devuelve su ID"""
+    job_id = uuid.uuid4().hex[:8]
+    with broadcast_jobs_lock:
+        broadcast_jobs[job_id] = {
+            'id': job_id,
+            'command': command_name,
+            'alert': alert_text,
+            'status': status,
+            'total': 0,
+            'sent': 0,
+            'failed': 0,
+            'pending': 0,
+            'skipped': 0,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None
+        }
+        # Conservar solo el historial más reciente
+        while len(broadcast_jobs) > BROADCAST_JOB_HISTORY:
+            broadcast_jobs.popitem(last=False)
+    return job_id
+
+def submit_broadcast_job(alert_text, command_name, job_id=None):
+    """Encola una difusión de mensajes directos y devuelve su ID de inmediato
+
+    Con `job_id` usa el trabajo ya registrado al agrupar alertas.
+    """
+    if job_id is None:
+        job_id = register_broadcast_job(alert_text, command_name)
+    else:
+        update_broadcast_job(job_id, alert=alert_text, command=command_name, status='queued')
+    broadcast_executor.submit(run_broadcast_job, job_id, alert_text, command_name)
+    logging.info(f"📨 Difusión {job_id} encolada para {command_name}")
+    return job_id
+
+# Alertas en espera de difusión por chat: {chat_id: {'job_id', 'alerts': [(etiqueta, comando), ...]}}
+pending_chat_alerts = {}
+pending_chat_alerts_lock = threading.Lock()
+
+def queue_alert_broadcast(chat_id, alert_text, command_name):
+    """Agrupa las alertas de un chat dentro de DM_COALESCE_WINDOW en una sola difusión
+
+    Devuelve el ID de la difusión: las alertas agrupadas comparten el que se
+    registró con la primera, así se puede consultar con /difusiones desde ya.
+    """
+    if DM_COALESCE_WINDOW <= 0:
+        return submit_broadcast_job(alert_text, command_name)
+    
+    with pending_chat_alerts_lock:
+        pending = pending_chat_alerts.get(chat_id)
+        first_alert = pending is None
+        if first_alert:
+            pending = pending_chat_alerts[chat_id] = {
+                'job_id': register_broadcast_job(alert_text, command_name, status='grouping'),
+                'alerts': []
+            }
+        pending['alerts'].append((alert_text, command_name))
+        job_id = pending['job_id']
+        grouped = len(pending['alerts']) - 1
+    
+    if first_alert:
+        timer = threading.Timer(DM_COALESCE_WINDOW, flush_alert_broadcast, args=(chat_id,))
+        timer.daemon = True
+        timer.start()
+    else:
+        logging.info(f"🧩 Alerta {command_name} agrupada con {grouped} anteriores del chat {chat_id} en la difusión {job_id}")
+    return job_id
+
+def flush_alert_broadcast(chat_id):
+    """Envía como una sola difusión las alertas agrupadas de un chat"""
+    with pending_chat_alerts_lock:
+        pending = pending_chat_alerts.pop(chat_id, None)
+    if not pending:
+        return None
+    alerts = pending['alerts']
+    if len(alerts) == 1:
+        return submit_broadcast_job(*alerts[0], job_id=pending['job_id'])
+    
+    commands = list(dict.fromkeys(command_name for _, command_name in alerts))
+    alert_text = f"{len(alerts)} alertas en los últimos {DM_COALESCE_WINDOW:g} segundos"
+    for text, command_name in alerts:
+        alert_text += f"\n• {command_name} - {text}"
+    return submit_broadcast_job(alert_text, ", ".join(commands), job_id=pending['job_id'])
+
+def format_broadcast_job(job):
+    """Texto legible del progreso de un trabajo de difusión"""
+    created = datetime.fromtimestamp(job['created_at']).strftime("%d/%m/%Y %H:%M:%S") if job['created_at'] else "-"
+    return (
+        f"🆔 {job['id']} - {job['command']} ({job['status']})\n"
+        f"   📅 {created}\n"
+        f"   ✅ Enviados: {job['sent']}  ❌ Fallidos: {job['failed']}  ⏳ Pendientes: {job['pending']}  (Total: {job['total']})\n"
+        f"   ⏭️ Omitidos por caché negativa: {job.get('skipped', 0)}\n"
+    )
 
 def search_nba_season_start():
     """Busca la fecha de inicio de la temporada NBA 2025-26"""
@@ -543,91 +2707,611 @@ def clean_name_for_mention(name):
     
     return name
 
-def clean_text_for_telegram(text):
-    """Limpia texto para enviar a Telegram sin formato"""
-    if not text:
-        return ""
-    
-    # Convertir a string
-    text = str(text)
-    
-    # Remover caracteres de control problemáticos
-    text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\r\t')
-    
-    # Remover caracteres especiales de Markdown
-    markdown_chars = ['*', '_', '`', '[', ']', '(', ')', '~', '>', '#', '+', '-', '=', '|', '{', '}', '!']
-    for char in markdown_chars:
-        text = text.replace(char, '')
-    
-    return text
+def clean_text_for_telegram(text):
+    """Limpia texto para enviar a Telegram sin formato"""
+    if not text:
+        return ""
+    
+    # Convertir a string
+    text = str(text)
+    
+    # Remover caracteres de control problemáticos
+    text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\r\t')
+    
+    # Remover caracteres especiales de Markdown
+    markdown_chars = ['*', '_', '`', '[', ']', '(', ')', '~', '>', '#', '+', '-', '=', '|', '{', '}', '!']
+    for char in markdown_chars:
+        text = text.replace(char, '')
+    
+    return text
+
+def create_safe_mention_text(mention_text, mentions):
+    """Crea texto de menciones seguro para Markdown"""
+    try:
+        # Crear el texto base
+        result_text = mention_text
+        
+        # Agregar menciones de forma segura
+        if mentions:
+            # Dividir menciones en grupos de 5 para evitar límites
+            for i in range(0, len(mentions), 5):
+                batch = mentions[i:i+5]
+                result_text += " ".join(batch) + "\n"
+        
+        return result_text
+    except Exception as e:
+        logging.error(f"Error al crear texto de menciones: {e}")
+        # Fallback: enviar sin menciones
+        return mention_text + "\n(Error al procesar menciones)"
+
+def utf16_length(text):
+    """Longitud de un texto en unidades UTF-16 (las que usa Telegram para offsets)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def make_mention_item(user_id, username=None, first_name=None, last_name=None):
+    """Prepara una mención con sus fragmentos ya renderizados para ambos modos"""
+    raw_name = f"{first_name or ''} {last_name or ''}"
+    name = ' '.join(''.join(char for char in raw_name if ord(char) >= 32).split()) or "Usuario"
+
+    if username:
+        markdown = f"@{clean_name_for_mention(username)}"
+        text = f"@{username}"
+    else:
+        full_name = clean_name_for_mention(first_name or "Usuario")
+        if last_name:
+            full_name += f" {clean_name_for_mention(last_name)}"
+        markdown = f"[{full_name}](tg://user?id={user_id})"
+        text = name
+
+    return {
+        'user_id': user_id,
+        'username': username,
+        'name': name,
+        'markdown': markdown,
+        'text': text
+    }
+
+def render_mentions_markdown(header, mentions):
+    """Renderiza las menciones como texto Markdown (modo heredado)"""
+    return create_safe_mention_text(header, [item['markdown'] for item in mentions])
+
+def render_mentions_entities(header, mentions):
+    """Renderiza las menciones como texto plano más una lista de MessageEntity.
+
+    Los offsets se calculan en unidades UTF-16, por lo que el mensaje se envía
+    sin parse_mode y sin necesidad de escapar nombres.
+    """
+    text = header
+    offset = utf16_length(header)
+    entities = []
+
+    for i, item in enumerate(mentions):
+        fragment = item['text']
+        length = utf16_length(fragment)
+        if item['username']:
+            entities.append(types.MessageEntity('mention', offset, length))
+        else:
+            # Se pasa el usuario como diccionario para que se serialice tal cual
+            user = {'id': item['user_id'], 'is_bot': False, 'first_name': item['name']}
+            entities.append(types.MessageEntity('text_mention', offset, length, user=user))
+
+        separator = "\n" if (i + 1) % 5 == 0 or i == len(mentions) - 1 else " "
+        text += fragment + separator
+        offset += length + utf16_length(separator)
+
+    return text, entities
+
+def iter_mention_chunks(header, mentions):
+    """Agrupa las menciones en la menor cantidad de mensajes posible.
+
+    Acepta cualquier iterable (incluso uno que se va resolviendo) y entrega
+    cada mensaje apenas se completa. Cada mensaje respeta MAX_MESSAGE_LENGTH y
+    MAX_MENTIONS_PER_MESSAGE; el encabezado solo va en el primero. Entrega
+    tuplas (encabezado, menciones).
+    """
+    fragment_key = 'markdown' if MENTION_RENDER_MODE == 'markdown' else 'text'
+    chunk_header = header
+    chunk = []
+    length = utf16_length(header)
+
+    for item in mentions:
+        # Cada mención ocupa su fragmento más un separador (espacio o salto de línea)
+        item_length = utf16_length(item[fragment_key]) + 1
+        if chunk and length + item_length > MAX_MESSAGE_LENGTH:
+            yield chunk_header, chunk
+            chunk_header = ""
+            chunk = []
+            length = 0
+        chunk.append(item)
+        length += item_length
+        if len(chunk) >= MAX_MENTIONS_PER_MESSAGE:
+            yield chunk_header, chunk
+            chunk_header = ""
+            chunk = []
+            length = 0
+
+    if chunk:
+        yield chunk_header, chunk
+
+def send_mentions(chat_id, header, mentions):
+    """Envía las menciones según MENTION_RENDER_MODE, divididas en varios mensajes si hace falta.
+
+    Cada mensaje pasa al planificador de envíos apenas se completa y se espera
+    su resultado antes de armar el siguiente, así llegan en orden. Lo envía uno
+    de los OUTBOUND_SEND_WORKERS hilos de outbound_executor, cada uno con su
+    propia sesión HTTP de telebot (apihelper guarda una por hilo) que reutiliza
+    entre envíos. Devuelve la cantidad de menciones enviadas.
+    """
+    chunk_count = 0
+    mention_count = 0
+    for chunk_header, chunk in iter_mention_chunks(header, mentions):
+        if MENTION_RENDER_MODE == 'markdown':
+            sent = safe_send_message(chat_id, render_mentions_markdown(chunk_header, chunk), parse_mode='Markdown')
+        else:
+            text, entities = render_mentions_entities(chunk_header, chunk)
+            sent = safe_send_message(chat_id, text, parse_mode=None, entities=entities)
+        chunk_count += 1
+        if sent:
+            mention_count += len(chunk)
+
+    if chunk_count > 1:
+        logging.info(f"✂️ Menciones divididas en {chunk_count} mensajes para el chat {chat_id}")
+    return mention_count
+
+def validate_markdown_text(text):
+    """Valida si un texto es seguro para Markdown"""
+    if not text:
+        return False
+    
+    # Verificar patrones problemáticos (pero permitir enlaces válidos)
+    problematic_patterns = [
+        '**', '__', '``', '~~', '>>', '##', '++', '--', '==', '||', '{{', '}}'
+    ]
+    
+    for pattern in problematic_patterns:
+        if pattern in text:
+            return False
+    
+    # Verificar caracteres especiales problemáticos (pero permitir enlaces)
+    # Solo rechazar si hay caracteres especiales que no sean parte de enlaces válidos
+    special_chars = ['*', '_', '`', '~', '>', '#', '+', '-', '=', '|', '{', '}', '!']
+    for char in special_chars:
+        if char in text and f'\\{char}' not in text:
+            return False
+    
+    # Permitir enlaces válidos de Telegram: [texto](tg://user?id=123)
+    # No rechazar por tener [ o ] si son parte de un enlace válido
+
+    return True
+
+# Pool compartido para consultar miembros en paralelo sin bloquear el hilo de polling
+member_lookup_executor = ThreadPoolExecutor(max_workers=MEMBER_LOOKUP_WORKERS, thread_name_prefix='member-lookup')
+
+def iter_resolved_chat_members(chat_id, user_ids, failed=None):
+    """Consulta get_chat_member para varios usuarios en paralelo.
+
+    Entrega pares (user_id, ChatMember) a medida que las consultas terminan,
+    omitiendo las que fallan o no responden a tiempo. Cada consulta dispone de
+    MEMBER_LOOKUP_TIMEOUT segundos contados desde que un hilo del pool la
+    empieza; las que esperan turno (el pool es compartido entre chats) no vencen.
+
+    Si se pasa la lista failed, se le agregan los usuarios cuya consulta falló
+    o venció. Un 400 de Telegram (el usuario nunca estuvo en el chat) es una
+    respuesta definitiva y no cuenta como fallo.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    started_at = {}
+
+    def lookup(user_id):
+        started_at[user_id] = time.monotonic()
+        return bot.get_chat_member(chat_id, user_id)
+
+    futures = {member_lookup_executor.submit(lookup, user_id): user_id for user_id in user_ids}
+    pending = set(futures)
+    timed_out = []
+    try:
+        while pending:
+            now = time.monotonic()
+            deadlines = {
+                future: started_at[futures[future]] + MEMBER_LOOKUP_TIMEOUT
+                for future in pending if futures[future] in started_at
+            }
+            expired = {future for future, deadline in deadlines.items() if deadline <= now and not future.done()}
+            timed_out.extend(futures[future] for future in expired)
+            pending -= expired
+            if not pending:
+                break
+            next_deadline = min((deadline for future, deadline in deadlines.items() if future in pending), default=now + MEMBER_LOOKUP_TIMEOUT)
+            done, _ = wait(pending, timeout=max(next_deadline - now, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                user_id = futures[future]
+                try:
+                    member = future.result()
+                except Exception as e:
+                    logging.error(f"Error al obtener usuario {user_id}: {e}")
+                    if failed is not None and not (isinstance(e, ApiTelegramException) and e.error_code == 400):
+                        failed.append(user_id)
+                    continue
+                yield user_id, member
+    finally:
+        for future in futures:
+            future.cancel()
+        if failed is not None:
+            failed.extend(timed_out)
+        if timed_out:
+            logging.warning(f"⚠️ {len(timed_out)} consultas de miembros excedieron el tiempo límite en el chat {chat_id}")
+
+# Estados de Telegram que cuentan como miembro presente en el grupo
+ACTIVE_MEMBER_STATUSES = ['member', 'administrator', 'creator']
+
+# Índice en memoria: {chat_id: {user_id: {status, username, first_name, last_name, updated_at}}}
+chat_membership_index = {}
+membership_index_lock = threading.Lock()
+membership_index_dirty = False
+
+# Menciones precalculadas por chat, compartidas por todos los tipos de alerta
+mention_roster_cache = {}
+mention_roster_lock = threading.Lock()
+
+def invalidate_mention_rosters(chat_id=None):
+    """Descarta las menciones precalculadas de un chat (o de todos)"""
+    with mention_roster_lock:
+        if chat_id is None:
+            mention_roster_cache.clear()
+        else:
+            mention_roster_cache.pop(chat_id, None)
+
+def load_membership_index():
+    """Carga el índice de miembros desde el archivo local"""
+    try:
+        if not os.path.exists(MEMBERSHIP_INDEX_PATH):
+            return {}
+        with open(MEMBERSHIP_INDEX_PATH, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        index = {
+            int(chat_id): {int(user_id): entry for user_id, entry in members.items()}
+            for chat_id, members in raw.items()
+        }
+        logging.info(f"✅ Índice de miembros cargado: {sum(len(m) for m in index.values())} entradas en {len(index)} chats")
+        return index
+    except Exception as e:
+        logging.error(f"❌ Error al cargar índice de miembros: {e}")
+        return {}
+
+def save_membership_index(force=False):
+    """Guarda el índice de miembros en el archivo local si hubo cambios"""
+    global membership_index_dirty
+    try:
+        with membership_index_lock:
+            if not membership_index_dirty and not force:
+                return
+            snapshot = {
+                str(chat_id): {str(user_id): dict(entry) for user_id, entry in members.items()}
+                for chat_id, members in chat_membership_index.items()
+            }
+            membership_index_dirty = False
+
+        tmp_path = f"{MEMBERSHIP_INDEX_PATH}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, MEMBERSHIP_INDEX_PATH)
+    except Exception as e:
+        logging.error(f"❌ Error al guardar índice de miembros: {e}")
+
+def membership_index_saver():
+    """Hilo que persiste periódicamente el índice de miembros"""
+    while True:
+        time.sleep(MEMBERSHIP_INDEX_SAVE_INTERVAL)
+        save_membership_index()
+
+def record_chat_member(chat_id, user, status=None):
+    """Actualiza el índice con el estado de un usuario en un chat.
+
+    Con status=None el usuario se considera presente: se conserva su estado
+    si ya estaba activo (p. ej. administrador) o se marca como 'member'.
+    """
+    global membership_index_dirty
+    if user is None or user.is_bot:
+        return
+    with membership_index_lock:
+        members = chat_membership_index.setdefault(chat_id, {})
+        existing = members.get(user.id)
+        if status is None:
+            if existing and existing['status'] in ACTIVE_MEMBER_STATUSES:
+                status = existing['status']
+            else:
+                status = 'member'
+        entry = {
+            'status': status,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'updated_at': time.time()
+        }
+        if existing and all(existing.get(k) == entry[k] for k in ('status', 'username', 'first_name', 'last_name')):
+            return
+        members[user.id] = entry
+        membership_index_dirty = True
+    invalidate_mention_rosters(chat_id)
+
+def forget_chat(chat_id):
+    """Elimina del índice toda la información de un chat"""
+    global membership_index_dirty
+    with membership_index_lock:
+        if chat_membership_index.pop(chat_id, None) is not None:
+            membership_index_dirty = True
+    invalidate_mention_rosters(chat_id)
+
+def iter_chat_roster_members(chat_id, user_ids, failed=None):
+    """Entrega (user_id, entrada del índice) de los usuarios presentes en el chat.
+
+    Primero salen los usuarios que el índice ya conoce; luego, a medida que
+    responden, los que hubo que consultar a Telegram (que alimentan el índice).
+    Las consultas que fallan se agregan a failed (ver iter_resolved_chat_members).
+    """
+    with membership_index_lock:
+        known = dict(chat_membership_index.get(chat_id, {}))
+
+    unknown = []
+    for user_id in user_ids:
+        entry = known.get(user_id)
+        if entry is None:
+            unknown.append(user_id)
+        elif entry['status'] in ACTIVE_MEMBER_STATUSES:
+            yield user_id, entry
+
+    if unknown:
+        logging.info(f"🔍 Consultando {len(unknown)} usuarios desconocidos en el chat {chat_id}")
+        for user_id, member in iter_resolved_chat_members(chat_id, unknown, failed):
+            record_chat_member(chat_id, member.user, member.status)
+            with membership_index_lock:
+                entry = chat_membership_index.get(chat_id, {}).get(user_id)
+            if entry and entry['status'] in ACTIVE_MEMBER_STATUSES:
+                yield user_id, entry
+
+# Caché de metadatos por chat: {chat_id: {clave: (valor, obtenido_en)}}
+chat_metadata_cache = {}
+chat_metadata_lock = threading.Lock()
+chat_metadata_stats = {'hits': 0, 'misses': 0}
+
+def get_chat_metadata(chat_id, key, fetch):
+    """Devuelve un metadato del chat desde la caché o lo obtiene de Telegram"""
+    now = time.time()
+    with chat_metadata_lock:
+        cached = chat_metadata_cache.get(chat_id, {}).get(key)
+        if cached and now - cached[1] < CHAT_METADATA_TTL:
+            chat_metadata_stats['hits'] += 1
+            return cached[0]
+        chat_metadata_stats['misses'] += 1
+
+    value = fetch(chat_id)
+    with chat_metadata_lock:
+        chat_metadata_cache.setdefault(chat_id, {})[key] = (value, now)
+    return value
+
+def invalidate_chat_metadata(chat_id, key=None):
+    """Descarta los metadatos en caché de un chat (o solo una clave)"""
+    with chat_metadata_lock:
+        if key is None:
+            chat_metadata_cache.pop(chat_id, None)
+        else:
+            chat_metadata_cache.get(chat_id, {}).pop(key, None)
+    if key in (None, 'administrators'):
+        invalidate_mention_rosters(chat_id)
+
+def get_cached_chat_administrators(chat_id):
+    """Administradores del chat con caché"""
+    return get_chat_metadata(chat_id, 'administrators', bot.get_chat_administrators)
+
+def get_cached_chat_member_count(chat_id):
+    """Cantidad de miembros del chat con caché"""
+    return get_chat_metadata(chat_id, 'member_count', bot.get_chat_member_count)
+
+def is_chat_admin(chat_id, user_id):
+    """Indica si un usuario es administrador del chat usando la lista en caché"""
+    return any(admin.user.id == user_id for admin in get_cached_chat_administrators(chat_id))
+
+# Clases de prioridad del planificador (menor número = sale antes)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 10
+
+class TokenBucket:
+    """Balde de fichas: permite `capacity` envíos seguidos y repone `rate` por segundo"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        """Segundos hasta que haya una ficha disponible"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+# Estado del planificador: cola por prioridad y baldes global, por chat y por grupo
+outbound_condition = threading.Condition()
+outbound_queue = []
+outbound_sequence = itertools.count()
+outbound_in_flight = set()
+global_send_bucket = TokenBucket(GLOBAL_SEND_RATE / SEND_PROCESSES, GLOBAL_SEND_RATE / SEND_PROCESSES)
+chat_send_buckets = {}
+group_send_buckets = {}
+# Esperas impuestas por Telegram (429 retry_after): {chat_id: instante monotónico}
+flood_wait_until = {}
+outbound_executor = ThreadPoolExecutor(max_workers=OUTBOUND_SEND_WORKERS, thread_name_prefix='outbound-send')
 
-def create_safe_mention_text(mention_text, mentions):
-    """Crea texto de menciones seguro para Markdown"""
+def chat_send_wait_time(chat_id, now):
+    """Segundos que debe esperar un envío a este chat según sus baldes"""
+    if chat_id in outbound_in_flight:
+        return None  # Hay un envío en curso: se mantiene el orden de los mensajes del chat
+    bucket = chat_send_buckets.setdefault(chat_id, TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST))
+    wait = bucket.wait_time(now)
+    if chat_id in flood_wait_until:
+        flood_wait = flood_wait_until[chat_id] - now
+        if flood_wait <= 0:
+            del flood_wait_until[chat_id]
+        else:
+            wait = max(wait, flood_wait)
+    if chat_id < 0:
+        # Los IDs negativos son grupos, supergrupos o canales
+        group_bucket = group_send_buckets.setdefault(chat_id, TokenBucket(GROUP_SEND_PER_MINUTE / 60, GROUP_SEND_BURST))
+        wait = max(wait, group_bucket.wait_time(now))
+    return wait
+
+def purge_idle_send_buckets(now):
+    """Descarta los baldes llenos (chats inactivos) para acotar la memoria"""
+    for buckets in (chat_send_buckets, group_send_buckets):
+        for chat_id in [chat_id for chat_id, bucket in buckets.items() if bucket.is_full(now)]:
+            del buckets[chat_id]
+
+def get_retry_after(error):
+    """Segundos de espera indicados por Telegram en un error 429, o None"""
+    if not isinstance(error, ApiTelegramException) or error.error_code != 429:
+        return None
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+def run_outbound_job(job):
+    """Ejecuta un envío en el pool y libera su chat al terminar.
+
+    Ante un 429 el trabajo vuelve a la cola y el chat queda en espera durante
+    exactamente retry_after segundos, sin dormir el hilo; los demás envíos al
+    mismo chat también respetan esa espera.
+    """
+    chat_id = job['chat_id']
+    requeue = False
     try:
-        # Crear el texto base
-        result_text = mention_text
-        
-        # Agregar menciones de forma segura
-        if mentions:
-            # Dividir menciones en grupos de 5 para evitar límites
-            for i in range(0, len(mentions), 5):
-                batch = mentions[i:i+5]
-                result_text += " ".join(batch) + "\n"
-        
-        return result_text
+        if job['attempts'] == 0 and not job['future'].set_running_or_notify_cancel():
+            return
+        job['attempts'] += 1
+        job['future'].set_result(job['call']())
     except Exception as e:
-        logging.error(f"Error al crear texto de menciones: {e}")
-        # Fallback: enviar sin menciones
-        return mention_text + "\n(Error al procesar menciones)"
+        retry_after = get_retry_after(e)
+        if retry_after is not None and job['attempts'] <= FLOOD_WAIT_MAX_RETRIES:
+            logging.warning(f"⏳ Telegram pidió esperar {retry_after}s antes de enviar al chat {chat_id}")
+            requeue = True
+            with outbound_condition:
+                flood_wait_until[chat_id] = max(flood_wait_until.get(chat_id, 0), time.monotonic() + retry_after)
+        else:
+            job['future'].set_exception(e)
+    finally:
+        with outbound_condition:
+            outbound_in_flight.discard(chat_id)
+            if requeue:
+                heapq.heappush(outbound_queue, (job['priority'], job['sequence'], job))
+            outbound_condition.notify()
 
-def validate_markdown_text(text):
-    """Valida si un texto es seguro para Markdown"""
-    if not text:
-        return False
-    
-    # Verificar patrones problemáticos (pero permitir enlaces válidos)
-    problematic_patterns = [
-        '**', '__', '``', '~~', '>>', '##', '++', '--', '==', '||', '{{', '}}'
-    ]
-    
-    for pattern in problematic_patterns:
-        if pattern in text:
-            return False
-    
-    # Verificar caracteres especiales problemáticos (pero permitir enlaces)
-    # Solo rechazar si hay caracteres especiales que no sean parte de enlaces válidos
-    special_chars = ['*', '_', '`', '~', '>', '#', '+', '-', '=', '|', '{', '}', '!']
-    for char in special_chars:
-        if char in text and f'\\{char}' not in text:
-            return False
-    
-    # Permitir enlaces válidos de Telegram: [texto](tg://user?id=123)
-    # No rechazar por tener [ o ] si son parte de un enlace válido
-    
-    return True
+def outbound_dispatcher():
+    """Hilo que despacha los envíos en orden de prioridad respetando los límites de Telegram"""
+    dispatched = 0
+    with outbound_condition:
+        while True:
+            if not outbound_queue:
+                outbound_condition.wait()
+                continue
+
+            now = time.monotonic()
+            global_wait = global_send_bucket.wait_time(now)
+            if global_wait > 0:
+                outbound_condition.wait(global_wait)
+                continue
+
+            # Buscar el trabajo más prioritario cuyo chat pueda recibir ahora
+            skipped = []
+            ready_job = None
+            min_wait = None
+            while outbound_queue:
+                entry = heapq.heappop(outbound_queue)
+                wait = chat_send_wait_time(entry[2]['chat_id'], now)
+                if wait == 0:
+                    ready_job = entry[2]
+                    break
+                skipped.append(entry)
+                if wait is not None:
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+            for entry in skipped:
+                heapq.heappush(outbound_queue, entry)
 
+            if ready_job is None:
+                outbound_condition.wait(min_wait)
+                continue
+
+            chat_id = ready_job['chat_id']
+            global_send_bucket.consume(now)
+            chat_send_buckets[chat_id].consume(now)
+            if chat_id in group_send_buckets:
+                group_send_buckets[chat_id].consume(now)
+            outbound_in_flight.add(chat_id)
+            outbound_executor.submit(run_outbound_job, ready_job)
+
+            dispatched += 1
+            if dispatched % 1000 == 0:
+                purge_idle_send_buckets(now)
+
+def schedule_send(chat_id, call, priority=PRIORITY_INTERACTIVE):
+    """Encola una llamada de envío a Telegram y devuelve un Future con su resultado"""
+    future = Future()
+    job = {
+        'chat_id': chat_id,
+        'call': call,
+        'future': future,
+        'priority': priority,
+        'sequence': next(outbound_sequence),
+        'attempts': 0
+    }
+    with outbound_condition:
+        heapq.heappush(outbound_queue, (priority, job['sequence'], job))
+        outbound_condition.notify()
+    return future
 
-def safe_send_message(chat_id, text, parse_mode='Markdown', max_retries=5):
+def run_outbound(chat_id, call, priority=PRIORITY_INTERACTIVE):
+    """Envía a través del planificador y espera el resultado (propaga excepciones)"""
+    return schedule_send(chat_id, call, priority).result()
+
+threading.Thread(target=outbound_dispatcher, name='outbound-dispatcher', daemon=True).start()
+
+def safe_send_message(chat_id, text, parse_mode='Markdown', max_retries=5, entities=None):
     """Envía un mensaje con reintentos en caso de error de conexión"""
     for attempt in range(max_retries):
         try:
+            # Con entidades explícitas no hay parseo que pueda fallar
+            if entities:
+                run_outbound(chat_id, lambda: bot.send_message(chat_id, text, parse_mode=None, entities=entities))
+                return True
             # Si hay error de parseo de Markdown, intentar sin formato
             if parse_mode == 'Markdown':
                 try:
-                    bot.send_message(chat_id, text, parse_mode=parse_mode)
+                    run_outbound(chat_id, lambda: bot.send_message(chat_id, text, parse_mode=parse_mode))
                     return True
                 except Exception as markdown_error:
-                    if "can't parse entities" in str(markdown_error) or "Bad Request" in str(markdown_error):
+                    if isinstance(markdown_error, ApiTelegramException) and markdown_error.error_code == 400:
                         logging.warning(f"Error de Markdown, enviando sin formato: {markdown_error}")
                         logging.warning(f"Texto problemático: {repr(text)}")
                         # Limpiar el texto y enviar sin formato
                         clean_text = clean_text_for_telegram(text)
-                        bot.send_message(chat_id, clean_text, parse_mode=None)
+                        run_outbound(chat_id, lambda: bot.send_message(chat_id, clean_text, parse_mode=None))
                         return True
                     else:
                         raise markdown_error
             else:
-                bot.send_message(chat_id, text, parse_mode=parse_mode)
+                run_outbound(chat_id, lambda: bot.send_message(chat_id, text, parse_mode=parse_mode))
                 return True
         except (ConnectionError, Timeout, RequestException, NewConnectionError, MaxRetryError) as e:
             logging.warning(f"Intento {attempt + 1} fallido al enviar mensaje: {e}")
@@ -650,20 +3334,20 @@ def safe_reply_to(message, text, parse_mode='Markdown', max_retries=5):
             # Si hay error de parseo de Markdown, intentar sin formato
             if parse_mode == 'Markdown':
                 try:
-                    bot.reply_to(message, text, parse_mode=parse_mode)
+                    run_outbound(message.chat.id, lambda: bot.reply_to(message, text, parse_mode=parse_mode))
                     return True
                 except Exception as markdown_error:
-                    if "can't parse entities" in str(markdown_error) or "Bad Request" in str(markdown_error):
+                    if isinstance(markdown_error, ApiTelegramException) and markdown_error.error_code == 400:
                         logging.warning(f"Error de Markdown, enviando sin formato: {markdown_error}")
                         logging.warning(f"Texto problemático: {repr(text)}")
                         # Limpiar el texto y enviar sin formato
                         clean_text = clean_text_for_telegram(text)
-                        bot.reply_to(message, clean_text, parse_mode=None)
+                        run_outbound(message.chat.id, lambda: bot.reply_to(message, clean_text, parse_mode=None))
                         return True
                     else:
                         raise markdown_error
             else:
-                bot.reply_to(message, text, parse_mode=parse_mode)
+                run_outbound(message.chat.id, lambda: bot.reply_to(message, text, parse_mode=parse_mode))
                 return True
         except (ConnectionError, Timeout, RequestException, NewConnectionError, MaxRetryError) as e:
             logging.warning(f"Intento {attempt + 1} fallido al responder mensaje: {e}")
@@ -684,11 +3368,52 @@ if not init_database():
     logging.error("❌ No se pudo inicializar la base de datos. Saliendo...")
     exit(1)
 
-# Cargar usuarios registrados al iniciar
-registered_users = load_registered_users()
+# Escritura diferida del log de auditoría (se vacía también al apagar)
+threading.Thread(target=audit_log_flusher, name='audit-log-flusher', daemon=True).start()
+atexit.register(flush_audit_log)
+
+if OUTBOX_WORKER_MODE:
+    # Un proceso `--outbox-worker` no usa los conjuntos de usuarios ni la instantánea, el
+    # índice de miembros o la caché negativa (pisaría los archivos del bot): sus resultados
+    # de mensajes directos los aplica el proceso principal (apply_dm_results)
+    registered_users, direct_message_users = set(), set()
+else:
+    # Cargar usuarios: de la instantánea local al instante (y reconciliar en segundo plano),
+    # o desde la base de datos en paralelo y por páginas si no hay instantánea
+    user_snapshot = load_user_snapshot()
+    if user_snapshot:
+        registered_users, direct_message_users, user_sync_watermark = user_snapshot
+        logging.info(f"⚡ Instantánea de usuarios cargada: {len(registered_users)} registrados, {len(direct_message_users)} de mensajes directos")
+        threading.Thread(target=reconcile_user_sets, name='user-sets-reconcile', daemon=True).start()
+    else:
+        sync_started_at = utc_timestamp()
+        registered_users, direct_message_users, users_complete = load_startup_users()
+        # Sin carga completa no se guarda instantánea (quedaría sin usuarios)
+        user_sync_watermark = sync_started_at if users_complete else None
+    threading.Thread(target=user_snapshot_saver, name='user-snapshot-saver', daemon=True).start()
+    atexit.register(save_user_snapshot)
 
-# Cargar usuarios de mensajes directos al iniciar
-direct_message_users = load_direct_message_users()
+    # Cargar índice de miembros por chat y persistirlo periódicamente
+    chat_membership_index = load_membership_index()
+    threading.Thread(target=membership_index_saver, name='membership-index-saver', daemon=True).start()
+    atexit.register(save_membership_index)
+
+    # Cargar caché negativa de mensajes directos y persistirla periódicamente
+    dm_negative_cache = load_dm_negative_cache()
+    threading.Thread(target=dm_negative_cache_saver, name='dm-negative-cache-saver', daemon=True).start()
+    atexit.register(save_dm_negative_cache)
+
+def handle_shutdown_signal(signum, frame):
+    """SIGTERM (Render al desplegar o detener): sale con SystemExit para que corran los atexit
+    (log pendiente, instantánea de usuarios, índice de miembros y caché negativa)"""
+    logging.info(f"🛑 Señal {signum} recibida, guardando estado antes de salir")
+    raise SystemExit(0)
+
+# Python no ejecuta los atexit con SIGTERM si no hay un manejador
+signal.signal(signal.SIGTERM, handle_shutdown_signal)
+
+# Workers de la bandeja de salida (retoman difusiones pendientes tras un reinicio)
+start_outbox_workers()
 
 # Verificar conectividad antes de iniciar
 if not check_network_connectivity():
@@ -699,8 +3424,9 @@ if not check_network_connectivity():
         logging.error("❌ Conectividad de red no disponible. Saliendo...")
         exit(1)
 
-# Limpiar webhook al iniciar
-clear_webhook()
+# Limpiar webhook al iniciar (un worker de la bandeja de salida no recibe actualizaciones)
+if not OUTBOX_WORKER_MODE:
+    clear_webhook()
 
 @bot.message_handler(commands=['start'])
 def start_command(message):
@@ -746,12 +3472,13 @@ Comandos disponibles:
 • /nomensaje - Desregistrarse de mensajes directos
 • /testdirecto - Probar si el bot puede enviar mensajes directos
 • /listamensajes - Muestra usuarios registrados para mensajes directos
+• /difusiones - [ADMIN] Progreso de los mensajes directos de alertas
 • /admins - Menciona solo a los administradores
 • /register - Registrarse para recibir menciones (o responder a un mensaje para registrar a otro usuario)
 • /unregister - Desregistrarse de las menciones
 • /eliminar_usuario - [ADMIN] Eliminar usuario del registro de menciones
 • /registered - Muestra usuarios registrados
-• /historial - Muestra historial de registros
+• /historial [user=ID] [accion=X] [desde=DD/MM/AAAA] [hasta=DD/MM/AAAA] - Historial de registros con filtros
 • /backup - Crea respaldo de la base de datos
 • /count - Muestra estadísticas del grupo
 • /help - Muestra esta ayuda
@@ -760,6 +3487,8 @@ Comandos de administrador:
 • /eliminar_usuario - Elimina un usuario del registro de menciones
   Uso: Responder a un mensaje + /eliminar_usuario
   O bien: /eliminar_usuario <ID_de_usuario>
+• /difusiones - Muestra el progreso de las difusiones de mensajes directos
+  Uso: /difusiones o /difusiones <ID_de_difusión>
 
 Notas importantes:
 • El bot debe ser administrador del grupo
@@ -799,6 +3528,7 @@ def register_user(message):
             # Agregar a la base de datos
             if add_registered_user(user_id, username, first_name, last_name):
                 registered_users.add(user_id)
+                invalidate_mention_rosters()
                 
                 # Crear mención personalizada
                 mention_text = f"✅ ¡{first_name} registrado exitosamente!\n\n"
@@ -847,6 +3577,7 @@ def register_user(message):
             # Agregar a la base de datos
             if add_registered_user(user_id, username, first_name, last_name):
                 registered_users.add(user_id)
+                invalidate_mention_rosters()
                 
                 # Crear mención personalizada
                 mention_text = f"✅ ¡Registro exitoso!\n\n"
@@ -878,6 +3609,7 @@ def unregister_user(message):
         # Remover de la base de datos
         if remove_registered_user(user_id):
             registered_users.remove(user_id)
+            invalidate_mention_rosters()
             safe_reply_to(message, "✅ Te has desregistrado de las menciones.")
         else:
             safe_reply_to(message, "❌ Ocurrió un error al desregistrarte de la base de datos. Intenta de nuevo.")
@@ -886,164 +3618,111 @@ def unregister_user(message):
         logging.error(f"Error al desregistrar usuario: {e}")
         safe_reply_to(message, "❌ Ocurrió un error al desregistrarte. Intenta de nuevo.")
 
-@bot.message_handler(commands=['all'])
-def mention_all(message):
-    """Menciona a todos los miembros del grupo"""
-    try:
-        chat_id = message.chat.id
-        
-        if message.chat.type not in ['group', 'supergroup']:
-            safe_reply_to(message, "❌ Este comando solo funciona en grupos.")
-            return
-        
-        # Obtener información del chat
-        chat_member_count = bot.get_chat_member_count(chat_id)
-        
-        mention_text = f"🔔 MENCIÓN GENERAL 🔔\n\n"
-        mention_text += f"Total de miembros: {chat_member_count}\n"
-        mention_text += f"📝 Usuarios registrados: {len(registered_users)}\n\n"
-        
-        # Obtener administradores
-        administrators = bot.get_chat_administrators(chat_id)
-        
-        # Lista para almacenar las menciones
-        mentions = []
-        mentioned_users = set()
-        
-        # Agregar administradores primero
-        for admin in administrators:
-            if not admin.user.is_bot:
-                if admin.user.username:
-                    clean_username = clean_name_for_mention(admin.user.username)
-                    if f"@{clean_username}" not in mentioned_users:
-                        mentions.append(f"@{clean_username}")
-                        mentioned_users.add(f"@{clean_username}")
-                else:
-                    user_id = admin.user.id
-                    if f"user_{user_id}" not in mentioned_users:
-                        full_name = clean_name_for_mention(admin.user.first_name or "Usuario")
-                        if admin.user.last_name:
-                            full_name += f" {clean_name_for_mention(admin.user.last_name)}"
-                        mentions.append(f"[{full_name}](tg://user?id={user_id})")
-                        mentioned_users.add(f"user_{user_id}")
-        
-        # Agregar usuarios registrados que no sean administradores
-        for user_id in registered_users:
-            try:
-                # Verificar si el usuario está en el grupo
-                member = bot.get_chat_member(chat_id, user_id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    if member.user.username:
-                        clean_username = clean_name_for_mention(member.user.username)
-                        if f"@{clean_username}" not in mentioned_users:
-                            mentions.append(f"@{clean_username}")
-                            mentioned_users.add(f"@{clean_username}")
-                    else:
-                        if f"user_{user_id}" not in mentioned_users:
-                            full_name = escape_markdown(member.user.first_name)
-                            if member.user.last_name:
-                                full_name += f" {escape_markdown(member.user.last_name)}"
-                            mentions.append(f"[{full_name}](tg://user?id={user_id})")
-                            mentioned_users.add(f"user_{user_id}")
-            except Exception as e:
-                logging.error(f"Error al obtener usuario {user_id}: {e}")
-                continue
-        
-        if mentions:
-            # Crear texto de menciones seguro
-            final_text = create_safe_mention_text(mention_text, mentions)
-            safe_send_message(chat_id, final_text, parse_mode='Markdown')
-            
-            # Enviar mensajes directos a usuarios registrados
-            send_direct_messages_to_users("MENCIÓN GENERAL", "/all")
-        else:
-            safe_reply_to(message, "❌ No se pudieron obtener los miembros del grupo.")
-            
-    except Exception as e:
-        logging.error(f"Error al mencionar a todos: {e}")
-        safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
+# Definiciones de alertas: agregar un tipo nuevo solo requiere una entrada aquí
+ALERT_DEFINITIONS = [
+    {
+        'command': 'all',
+        'header': (
+            "🔔 MENCIÓN GENERAL 🔔\n\n"
+            "Total de miembros: {member_count}\n"
+            "📝 Usuarios registrados: {registered_count}\n\n"
+        ),
+        'dm_label': "MENCIÓN GENERAL",
+        'error_log': "Error al mencionar a todos"
+    },
+    {
+        'command': 'allbug',
+        'header': (
+            "🚨 ALERTA DE BUG 🚨\n\n"
+            "Total de miembros: {member_count}\n"
+            "📝 Usuarios registrados: {registered_count}\n\n"
+            "⚠️ Se ha detectado un bug crítico que requiere atención inmediata\n\n"
+        ),
+        'dm_label': "ALERTA DE BUG CRÍTICO",
+        'error_log': "Error al mencionar para bug"
+    },
+    {
+        'command': 'allerror',
+        'header': (
+            "💥 ALERTA DE ERROR DE CUOTA 💥\n\n"
+            "Total de miembros: {member_count}\n"
+            "📝 Usuarios registrados: {registered_count}\n\n"
+            "⚠️ Se ha alcanzado el límite de cuota del sistema\n"
+            "🔧 Se requiere intervención inmediata del equipo técnico\n\n"
+        ),
+        'dm_label': "ALERTA DE ERROR DE CUOTA",
+        'error_log': "Error al mencionar para error"
+    },
+]
 
-@bot.message_handler(commands=['allbug'])
-def mention_all_bug(message):
-    """Menciona a todos para alerta de bug"""
-    try:
-        chat_id = message.chat.id
-        
-        if message.chat.type not in ['group', 'supergroup']:
-            safe_reply_to(message, "❌ Este comando solo funciona en grupos.")
-            return
-        
-        # Obtener información del chat
-        chat_member_count = bot.get_chat_member_count(chat_id)
-        
-        mention_text = f"🚨 ALERTA DE BUG 🚨\n\n"
-        mention_text += f"Total de miembros: {chat_member_count}\n"
-        mention_text += f"📝 Usuarios registrados: {len(registered_users)}\n\n"
-        mention_text += "⚠️ Se ha detectado un bug crítico que requiere atención inmediata\n\n"
-        
-        # Obtener administradores
-        administrators = bot.get_chat_administrators(chat_id)
-        
-        # Lista para almacenar las menciones
-        mentions = []
-        mentioned_users = set()
-        
-        # Agregar administradores primero
-        for admin in administrators:
-            if not admin.user.is_bot:
-                if admin.user.username:
-                    clean_username = clean_name_for_mention(admin.user.username)
-                    if f"@{clean_username}" not in mentioned_users:
-                        mentions.append(f"@{clean_username}")
-                        mentioned_users.add(f"@{clean_username}")
-                else:
-                    user_id = admin.user.id
-                    if f"user_{user_id}" not in mentioned_users:
-                        full_name = clean_name_for_mention(admin.user.first_name or "Usuario")
-                        if admin.user.last_name:
-                            full_name += f" {clean_name_for_mention(admin.user.last_name)}"
-                        mentions.append(f"[{full_name}](tg://user?id={user_id})")
-                        mentioned_users.add(f"user_{user_id}")
-        
-        # Agregar usuarios registrados que no sean administradores
-        for user_id in registered_users:
-            try:
-                # Verificar si el usuario está en el grupo
-                member = bot.get_chat_member(chat_id, user_id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    if member.user.username:
-                        clean_username = clean_name_for_mention(member.user.username)
-                        if f"@{clean_username}" not in mentioned_users:
-                            mentions.append(f"@{clean_username}")
-                            mentioned_users.add(f"@{clean_username}")
-                    else:
-                        if f"user_{user_id}" not in mentioned_users:
-                            full_name = escape_markdown(member.user.first_name)
-                            if member.user.last_name:
-                                full_name += f" {escape_markdown(member.user.last_name)}"
-                            mentions.append(f"[{full_name}](tg://user?id={user_id})")
-                            mentioned_users.add(f"user_{user_id}")
-            except Exception as e:
-                logging.error(f"Error al obtener usuario {user_id}: {e}")
-                continue
-        
-        if mentions:
-            # Crear texto de menciones seguro
-            final_text = create_safe_mention_text(mention_text, mentions)
-            safe_send_message(chat_id, final_text, parse_mode='Markdown')
-            
-            # Enviar mensajes directos a usuarios registrados
-            send_direct_messages_to_users("ALERTA DE BUG CRÍTICO", "/allbug")
-        else:
-            safe_reply_to(message, "❌ No se pudieron obtener los miembros del grupo.")
-            
-    except Exception as e:
-        logging.error(f"Error al mencionar para bug: {e}")
-        safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
+def iter_mention_roster(chat_id, failed=None):
+    """Entrega las menciones de un chat a medida que se conocen: administradores primero y luego registrados.
+
+    Los usuarios que no se pudieron consultar se agregan a failed.
+    """
+    # Obtener administradores
+    administrators = get_cached_chat_administrators(chat_id)
+    for admin in administrators:
+        record_chat_member(chat_id, admin.user, admin.status)
+
+    # Evitar duplicados por ID y por username
+    mentioned_users = set()
+
+    def new_mention(user_id, username, first_name, last_name):
+        keys = {f"user_{user_id}"}
+        if username:
+            keys.add(f"@{username.lower()}")
+        if keys & mentioned_users:
+            return None
+        mentioned_users.update(keys)
+        return make_mention_item(user_id, username, first_name, last_name)
+
+    # Agregar administradores primero
+    for admin in administrators:
+        if not admin.user.is_bot:
+            item = new_mention(admin.user.id, admin.user.username, admin.user.first_name, admin.user.last_name)
+            if item:
+                yield item
+
+    # Agregar usuarios registrados que no sean administradores
+    # (el índice de miembros evita consultar a Telegram por usuarios ya conocidos)
+    for user_id, member in iter_chat_roster_members(chat_id, list(registered_users), failed):
+        item = new_mention(user_id, member['username'], member['first_name'], member['last_name'])
+        if item:
+            yield item
+
+def stream_mention_roster(chat_id):
+    """Entrega las menciones de un chat desde la caché o a medida que se resuelven.
 
-@bot.message_handler(commands=['allerror'])
-def mention_all_error(message):
-    """Menciona a todos para alerta de error de cuota"""
+    Si hubo que construirlas, al terminar quedan guardadas para las siguientes alertas.
+    Una lista incompleta (alguna consulta falló o venció) se guarda solo por
+    MENTION_ROSTER_PARTIAL_TTL segundos para reintentar pronto a los que faltan.
+    """
+    now = time.time()
+    cached_mentions = None
+    with mention_roster_lock:
+        cached = mention_roster_cache.get(chat_id)
+        if cached and now - cached['built_at'] < cached['ttl']:
+            cached_mentions = list(cached['mentions'])
+    # Se entrega fuera del lock: entre cada mención el llamador envía mensajes
+    if cached_mentions is not None:
+        yield from cached_mentions
+        return
+
+    mentions = []
+    failed = []
+    for item in iter_mention_roster(chat_id, failed):
+        mentions.append(item)
+        yield item
+
+    if failed:
+        logging.warning(f"⚠️ Menciones incompletas en el chat {chat_id}: {len(failed)} usuarios sin consultar")
+    ttl = MENTION_ROSTER_PARTIAL_TTL if failed else MENTION_ROSTER_TTL
+    with mention_roster_lock:
+        mention_roster_cache[chat_id] = {'mentions': mentions, 'built_at': now, 'ttl': ttl}
+
+def handle_alert_command(message, alert):
+    """Motor común de los comandos de alerta: menciona a todos y avisa por mensaje directo"""
     try:
         chat_id = message.chat.id
         
@@ -1052,74 +3731,32 @@ def mention_all_error(message):
             return
         
         # Obtener información del chat
-        chat_member_count = bot.get_chat_member_count(chat_id)
-        
-        mention_text = f"💥 ALERTA DE ERROR DE CUOTA 💥\n\n"
-        mention_text += f"Total de miembros: {chat_member_count}\n"
-        mention_text += f"📝 Usuarios registrados: {len(registered_users)}\n\n"
-        mention_text += "⚠️ Se ha alcanzado el límite de cuota del sistema\n"
-        mention_text += "🔧 Se requiere intervención inmediata del equipo técnico\n\n"
-        
-        # Obtener administradores
-        administrators = bot.get_chat_administrators(chat_id)
-        
-        # Lista para almacenar las menciones
-        mentions = []
-        mentioned_users = set()
-        
-        # Agregar administradores primero
-        for admin in administrators:
-            if not admin.user.is_bot:
-                if admin.user.username:
-                    clean_username = clean_name_for_mention(admin.user.username)
-                    if f"@{clean_username}" not in mentioned_users:
-                        mentions.append(f"@{clean_username}")
-                        mentioned_users.add(f"@{clean_username}")
-                else:
-                    user_id = admin.user.id
-                    if f"user_{user_id}" not in mentioned_users:
-                        full_name = clean_name_for_mention(admin.user.first_name or "Usuario")
-                        if admin.user.last_name:
-                            full_name += f" {clean_name_for_mention(admin.user.last_name)}"
-                        mentions.append(f"[{full_name}](tg://user?id={user_id})")
-                        mentioned_users.add(f"user_{user_id}")
-        
-        # Agregar usuarios registrados que no sean administradores
-        for user_id in registered_users:
-            try:
-                # Verificar si el usuario está en el grupo
-                member = bot.get_chat_member(chat_id, user_id)
-                if member.status in ['member', 'administrator', 'creator']:
-                    if member.user.username:
-                        clean_username = clean_name_for_mention(member.user.username)
-                        if f"@{clean_username}" not in mentioned_users:
-                            mentions.append(f"@{clean_username}")
-                            mentioned_users.add(f"@{clean_username}")
-                    else:
-                        if f"user_{user_id}" not in mentioned_users:
-                            full_name = escape_markdown(member.user.first_name)
-                            if member.user.last_name:
-                                full_name += f" {escape_markdown(member.user.last_name)}"
-                            mentions.append(f"[{full_name}](tg://user?id={user_id})")
-                            mentioned_users.add(f"user_{user_id}")
-            except Exception as e:
-                logging.error(f"Error al obtener usuario {user_id}: {e}")
-                continue
+        chat_member_count = get_cached_chat_member_count(chat_id)
+        mention_text = alert['header'].format(
+            member_count=chat_member_count,
+            registered_count=len(registered_users)
+        )
         
-        if mentions:
-            # Crear texto de menciones seguro
-            final_text = create_safe_mention_text(mention_text, mentions)
-            safe_send_message(chat_id, final_text, parse_mode='Markdown')
-            
+        # Los primeros mensajes salen mientras el resto de las consultas sigue en curso
+        mention_count = send_mentions(chat_id, mention_text, stream_mention_roster(chat_id))
+        
+        if mention_count:
             # Enviar mensajes directos a usuarios registrados
-            send_direct_messages_to_users("ALERTA DE ERROR DE CUOTA", "/allerror")
+            job_id = queue_alert_broadcast(chat_id, alert['dm_label'], f"/{alert['command']}")
+            safe_reply_to(message, f"📨 Difusión {job_id} en curso. Progreso: /difusiones {job_id}", parse_mode=None)
         else:
             safe_reply_to(message, "❌ No se pudieron obtener los miembros del grupo.")
             
     except Exception as e:
-        logging.error(f"Error al mencionar para error: {e}")
+        logging.error(f"{alert['error_log']}: {e}")
         safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
 
+for alert_definition in ALERT_DEFINITIONS:
+    bot.register_message_handler(
+        lambda message, alert=alert_definition: handle_alert_command(message, alert),
+        commands=[alert_definition['command']]
+    )
+
 @bot.message_handler(commands=['admins'])
 def mention_admins(message):
     """Menciona solo a los administradores del grupo"""
@@ -1130,24 +3767,17 @@ def mention_admins(message):
             safe_reply_to(message, "❌ Este comando solo funciona en grupos.")
             return
         
-        administrators = bot.get_chat_administrators(chat_id)
+        administrators = get_cached_chat_administrators(chat_id)
         
         mention_text = "🔔 MENCIÓN A ADMINISTRADORES 🔔\n\n"
-        mentions = []
-        
-        for admin in administrators:
-            if not admin.user.is_bot and admin.user.username:
-                clean_username = clean_name_for_mention(admin.user.username)
-                mentions.append(f"@{clean_username}")
-            elif not admin.user.is_bot:
-                full_name = clean_name_for_mention(admin.user.first_name or "Usuario")
-                if admin.user.last_name:
-                    full_name += f" {clean_name_for_mention(admin.user.last_name)}"
-                mentions.append(f"[{full_name}](tg://user?id={admin.user.id})")
+        mentions = [
+            make_mention_item(admin.user.id, admin.user.username, admin.user.first_name, admin.user.last_name)
+            for admin in administrators
+            if not admin.user.is_bot
+        ]
         
         if mentions:
-            mention_text += " ".join(mentions)
-            safe_send_message(chat_id, mention_text, parse_mode='Markdown')
+            send_mentions(chat_id, mention_text, mentions)
         else:
             safe_reply_to(message, "❌ No se encontraron administradores.")
             
@@ -1165,8 +3795,8 @@ def count_members(message):
             safe_reply_to(message, "❌ Este comando solo funciona en grupos.")
             return
         
-        member_count = bot.get_chat_member_count(chat_id)
-        administrators = bot.get_chat_administrators(chat_id)
+        member_count = get_cached_chat_member_count(chat_id)
+        administrators = get_cached_chat_administrators(chat_id)
         
         admin_count = len([admin for admin in administrators if not admin.user.is_bot])
         
@@ -1187,46 +3817,144 @@ Nota: Solo puedo mencionar a administradores por limitaciones de la API de Teleg
         logging.error(f"Error al contar miembros: {e}")
         safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
 
+# Vistas paginadas: (chat_id, message_id) -> estado de la vista (tipo, filtros, pila de cursores)
+paged_views = OrderedDict()
+paged_views_lock = threading.Lock()
+paged_view_renderers = {}  # tipo -> función(view, cursor) que devuelve (texto, cursor_siguiente)
+
+def fetch_user_page(table, cursor, limit=PAGE_SIZE):
+    """Obtiene una página de usuarios por keyset (registered_at, user_id) descendente
+
+    Pide limit + 1 filas para saber si existe una página siguiente sin contar la tabla.
+    """
+    rows = storage.fetch_user_rows(table, cursor, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]['registered_at'], rows[-1]['user_id'])
+    return rows, next_cursor
+
+def format_user_line(position, user_data):
+    """Línea de listado de un usuario: posición, nombre e ID"""
+    username = user_data.get('username')
+    first_name = user_data.get('first_name')
+    last_name = user_data.get('last_name')
+    user_id = user_data.get('user_id')
+    
+    display_name = username if username else f"{first_name or 'Usuario'}"
+    if last_name:
+        display_name += f" {last_name}"
+    # Limpiar el nombre para evitar problemas de Markdown
+    clean_display_name = clean_text_for_telegram(display_name)
+    return f"{position}. {clean_display_name} (ID: {user_id})\n"
+
+def render_user_list_page(table, title, total, footer):
+    """Crea el renderizador de una página de un listado de usuarios"""
+    def render(view, cursor):
+        rows, next_cursor = fetch_user_page(table, cursor)
+        total_pages = max(1, -(-total() // PAGE_SIZE))
+        text = f"📊 {title}\n\n"
+        text += f"Total registrados: {total()}\n\n"
+        text += f"Página {view['page'] + 1} de {total_pages}:\n"
+        offset = view['page'] * PAGE_SIZE
+        for i, user_data in enumerate(rows):
+            text += format_user_line(offset + i + 1, user_data)
+        text += f"\n{footer}"
+        return text, next_cursor
+    return render
+
+paged_view_renderers['registered'] = render_user_list_page(
+    'registered_users',
+    "USUARIOS REGISTRADOS",
+    lambda: len(registered_users),
+    "Los usuarios registrados recibirán menciones especiales en los comandos de alerta."
+)
+paged_view_renderers['listamensajes'] = render_user_list_page(
+    'direct_message_users',
+    "USUARIOS REGISTRADOS PARA MENSAJES DIRECTOS",
+    lambda: len(direct_message_users),
+    "Estos usuarios recibirán mensajes directos cada vez que haya una alerta en el grupo."
+)
+
+def render_paged_view(view):
+    """Renderiza la página actual de una vista y sus botones de navegación"""
+    cursor = view['cursors'][view['page']]
+    text, next_cursor = paged_view_renderers[view['kind']](view, cursor)
+    view['next_cursor'] = next_cursor
+    
+    markup = None
+    buttons = []
+    if view['page'] > 0:
+        buttons.append(types.InlineKeyboardButton("⬅️ Anterior", callback_data='page:prev'))
+    if next_cursor:
+        buttons.append(types.InlineKeyboardButton("Siguiente ➡️", callback_data='page:next'))
+    if buttons:
+        markup = types.InlineKeyboardMarkup()
+        markup.row(*buttons)
+    return text, markup
+
+def send_paged_view(message, kind, filters=None):
+    """Responde con la primera página de una vista y la recuerda para los botones"""
+    view = {'kind': kind, 'filters': filters or {}, 'cursors': [None], 'page': 0, 'next_cursor': None}
+    text, markup = render_paged_view(view)
+    sent = run_outbound(message.chat.id, lambda: bot.reply_to(message, text, parse_mode=None, reply_markup=markup))
+    if markup:
+        with paged_views_lock:
+            paged_views[(sent.chat.id, sent.message_id)] = view
+            while len(paged_views) > PAGED_VIEW_MAX:
+                paged_views.popitem(last=False)
+
+@bot.callback_query_handler(func=lambda call: bool(call.data) and call.data.startswith('page:'))
+def paged_view_callback(call):
+    """Botones anterior/siguiente de los listados paginados"""
+    try:
+        chat_id = call.message.chat.id
+        message_id = call.message.message_id
+        action = call.data.split(':', 1)[1]
+        
+        with paged_views_lock:
+            view = paged_views.get((chat_id, message_id))
+            if view:
+                paged_views.move_to_end((chat_id, message_id))
+                if action == 'next' and view['next_cursor']:
+                    del view['cursors'][view['page'] + 1:]
+                    view['cursors'].append(view['next_cursor'])
+                    view['page'] += 1
+                elif action == 'prev' and view['page'] > 0:
+                    view['page'] -= 1
+                else:
+                    view = None
+                    action = None
+        
+        if not view:
+            text = "⌛ Este listado expiró, usa el comando de nuevo." if action else None
+            bot.answer_callback_query(call.id, text)
+            return
+        
+        text, markup = render_paged_view(view)
+        run_outbound(chat_id, lambda: bot.edit_message_text(text, chat_id, message_id, reply_markup=markup))
+        bot.answer_callback_query(call.id)
+        
+    except Exception as e:
+        logging.error(f"Error al cambiar de página: {e}")
+        try:
+            bot.answer_callback_query(call.id, "❌ No se pudo cargar la página.")
+        except Exception:
+            pass
+
 @bot.message_handler(commands=['registered'])
 def show_registered_users(message):
-    """Muestra los usuarios registrados"""
+    """Muestra los usuarios registrados (paginado)"""
     try:
         if not registered_users:
             safe_reply_to(message, "📝 No hay usuarios registrados.")
             return
         
-        # Obtener información detallada de Supabase
         try:
-            result = supabase.table('registered_users').select('user_id, username, first_name, last_name, registered_at').order('registered_at', desc=True).execute()
-            
-            users_info = result.data
-            
-            count_text = f"📊 USUARIOS REGISTRADOS\n\n"
-            count_text += f"Total registrados: {len(registered_users)}\n\n"
-            
-            # Mostrar últimos 10 usuarios registrados
-            count_text += "Últimos registros:\n"
-            for i, user_data in enumerate(users_info[:10]):
-                username = user_data.get('username')
-                first_name = user_data.get('first_name')
-                last_name = user_data.get('last_name')
-                user_id = user_data.get('user_id')
-                registered_at = user_data.get('registered_at')
-                
-                display_name = username if username else f"{first_name or 'Usuario'}"
-                if last_name:
-                    display_name += f" {last_name}"
-                # Limpiar el nombre para evitar problemas de Markdown
-                clean_display_name = clean_text_for_telegram(display_name)
-                count_text += f"{i+1}. {clean_display_name} (ID: {user_id})\n"
-            
-            if len(users_info) > 10:
-                count_text += f"\n... y {len(users_info) - 10} más"
-            
-            count_text += "\n\nLos usuarios registrados recibirán menciones especiales en los comandos de alerta."
-            
+            send_paged_view(message, 'registered')
+            return
         except Exception as db_error:
-            logging.error(f"Error al consultar Supabase: {db_error}")
+            logging.error(f"Error al consultar la base de datos: {db_error}")
             count_text = f"""
 📊 USUARIOS REGISTRADOS
 
@@ -1241,50 +3969,116 @@ Los usuarios registrados recibirán menciones especiales en los comandos de aler
         logging.error(f"Error al mostrar usuarios registrados: {e}")
         safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
 
+HISTORY_ACTION_EMOJIS = {
+    "REGISTRO": "✅",
+    "ACTUALIZACION": "🔄",
+    "ELIMINACION": "❌"
+}
+
+def parse_history_filters(text):
+    """Lee los filtros de /historial: user=ID accion=X desde=DD/MM/AAAA hasta=DD/MM/AAAA
+
+    Las fechas se interpretan en hora de Chile; 'hasta' incluye el día completo.
+    Lanza ValueError si algún filtro no es válido.
+    """
+    chile_tz = pytz.timezone('America/Santiago')
+    filters = {}
+    for part in text.split()[1:]:
+        key, sep, value = part.partition('=')
+        key = key.lower()
+        if not sep or not value:
+            raise ValueError(f"filtro inválido: {part}")
+        if key in ('user', 'usuario'):
+            if not value.isdigit():
+                raise ValueError(f"ID de usuario inválido: {value}")
+            filters['user_id'] = int(value)
+        elif key in ('accion', 'action'):
+            filters['action'] = value.upper()
+        elif key in ('desde', 'hasta'):
+            try:
+                day = chile_tz.localize(datetime.strptime(value, "%d/%m/%Y"))
+            except ValueError:
+                raise ValueError(f"fecha inválida: {value}")
+            if key == 'desde':
+                filters['since'] = day.isoformat()
+            else:
+                filters['until'] = (day + timedelta(days=1)).isoformat()
+        else:
+            raise ValueError(f"filtro desconocido: {key}")
+    return filters
+
+def fetch_log_page(filters, cursor, limit=PAGE_SIZE):
+    """Obtiene una página del log por keyset (timestamp, id) descendente
+
+    Usa los índices (timestamp DESC, id DESC) y (user_id, timestamp DESC) de SUPABASE_SETUP.md.
+    """
+    rows = storage.fetch_log_rows(filters, cursor, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]['timestamp'], rows[-1]['id'])
+    return rows, next_cursor
+
+def render_history_page(view, cursor):
+    """Renderiza una página de /historial"""
+    logs, next_cursor = fetch_log_page(view['filters'], cursor)
+    if not logs and view['page'] == 0:
+        return "📝 No hay historial de registros disponible.", None
+    
+    chile_tz = pytz.timezone('America/Santiago')
+    history_text = "📊 HISTORIAL DE REGISTROS\n\n"
+    filters = view['filters']
+    active_filters = []
+    if 'user_id' in filters:
+        active_filters.append(f"usuario {filters['user_id']}")
+    if 'action' in filters:
+        active_filters.append(f"acción {filters['action']}")
+    if 'since' in filters:
+        active_filters.append(f"desde {datetime.fromisoformat(filters['since']).strftime('%d/%m/%Y')}")
+    if 'until' in filters:
+        until = datetime.fromisoformat(filters['until']) - timedelta(days=1)
+        active_filters.append(f"hasta {until.strftime('%d/%m/%Y')}")
+    if active_filters:
+        history_text += f"🔎 Filtros: {', '.join(active_filters)}\n"
+    history_text += f"Página {view['page'] + 1}\n\n"
+    
+    for log in logs:
+        user_id = log.get('user_id')
+        action = log.get('action')
+        details = log.get('details')
+        timestamp = log.get('timestamp')
+        action_emoji = HISTORY_ACTION_EMOJIS.get(action, "📝")
+        
+        # Formatear timestamp en hora de Chile
+        try:
+            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+            if dt.tzinfo:
+                dt = dt.astimezone(chile_tz)
+            formatted_time = dt.strftime("%d/%m/%Y %H:%M")
+        except (AttributeError, ValueError):
+            formatted_time = timestamp
+        
+        history_text += f"{action_emoji} {action} - Usuario {user_id}\n"
+        history_text += f"   📅 {formatted_time}\n"
+        if details:
+            history_text += f"   📝 {details}\n"
+        history_text += "\n"
+    
+    return history_text, next_cursor
+
+paged_view_renderers['historial'] = render_history_page
+
 @bot.message_handler(commands=['historial', 'logs'])
 def show_registration_history(message):
-    """Muestra el historial de registros y acciones"""
+    """Muestra el historial de registros y acciones (filtrable y paginado)"""
     try:
-        # Obtener los últimos 20 registros desde Supabase
-        result = supabase.table('user_registration_log').select('user_id, action, details, timestamp').order('timestamp', desc=True).limit(20).execute()
-        
-        logs = result.data
-        
-        if not logs:
-            safe_reply_to(message, "📝 No hay historial de registros disponible.")
+        try:
+            filters = parse_history_filters(message.text or "")
+        except ValueError as filter_error:
+            safe_reply_to(message, f"❌ {filter_error}\n\nUso: /historial [user=ID] [accion=REGISTRO] [desde=DD/MM/AAAA] [hasta=DD/MM/AAAA]", parse_mode=None)
             return
         
-        history_text = "📊 HISTORIAL DE REGISTROS\n\n"
-        
-        for log in logs:
-            user_id = log.get('user_id')
-            action = log.get('action')
-            details = log.get('details')
-            timestamp = log.get('timestamp')
-            action_emoji = {
-                "REGISTRO": "✅",
-                "ACTUALIZACION": "🔄", 
-                "ELIMINACION": "❌"
-            }.get(action, "📝")
-            
-            # Formatear timestamp
-            try:
-                from datetime import datetime
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                formatted_time = dt.strftime("%d/%m/%Y %H:%M")
-            except:
-                formatted_time = timestamp
-            
-            history_text += f"{action_emoji} **{action}** - Usuario {user_id}\n"
-            history_text += f"   📅 {formatted_time}\n"
-            if details:
-                history_text += f"   📝 {details}\n"
-            history_text += "\n"
-        
-        if len(logs) == 20:
-            history_text += "... (mostrando últimos 20 registros)"
-        
-        safe_reply_to(message, history_text, parse_mode=None)
+        send_paged_view(message, 'historial', filters)
         
     except Exception as e:
         logging.error(f"Error al mostrar historial: {e}")
@@ -1362,41 +4156,17 @@ def nomensaje_command(message):
 
 @bot.message_handler(commands=['listamensajes'])
 def listamensajes_command(message):
-    """Muestra los usuarios registrados para mensajes directos"""
+    """Muestra los usuarios registrados para mensajes directos (paginado)"""
     try:
         if not direct_message_users:
             safe_reply_to(message, "📝 No hay usuarios registrados para mensajes directos.")
             return
         
-        # Obtener información detallada de Supabase
         try:
-            result = supabase.table('direct_message_users').select('user_id, username, first_name, last_name, registered_at').order('registered_at', desc=True).execute()
-            
-            users_info = result.data
-            
-            count_text = f"📊 USUARIOS REGISTRADOS PARA MENSAJES DIRECTOS\n\n"
-            count_text += f"Total registrados: {len(direct_message_users)}\n\n"
-            
-            # Mostrar todos los usuarios registrados
-            count_text += "Usuarios registrados:\n"
-            for i, user_data in enumerate(users_info):
-                username = user_data.get('username')
-                first_name = user_data.get('first_name')
-                last_name = user_data.get('last_name')
-                user_id = user_data.get('user_id')
-                registered_at = user_data.get('registered_at')
-                
-                display_name = username if username else f"{first_name or 'Usuario'}"
-                if last_name:
-                    display_name += f" {last_name}"
-                # Limpiar el nombre para evitar problemas de Markdown
-                clean_display_name = clean_text_for_telegram(display_name)
-                count_text += f"{i+1}. {clean_display_name} (ID: {user_id})\n"
-            
-            count_text += "\nEstos usuarios recibirán mensajes directos cada vez que haya una alerta en el grupo."
-            
+            send_paged_view(message, 'listamensajes')
+            return
         except Exception as db_error:
-            logging.error(f"Error al consultar Supabase: {db_error}")
+            logging.error(f"Error al consultar la base de datos: {db_error}")
             count_text = f"""
 📊 USUARIOS REGISTRADOS PARA MENSAJES DIRECTOS
 
@@ -1424,7 +4194,8 @@ def test_directo_command(message):
         test_message += "¡Perfecto! Recibirás notificaciones de alertas del grupo."
         
         try:
-            bot.send_message(user_id, test_message)
+            run_outbound(user_id, lambda: bot.send_message(user_id, test_message))
+            clear_dm_failure(user_id)
             safe_reply_to(message, "✅ Mensaje directo enviado exitosamente. ¡Puedes recibir notificaciones!")
             logging.info(f"✅ Prueba de mensaje directo exitosa para usuario {user_id}")
         except Exception as e:
@@ -1441,6 +4212,42 @@ def test_directo_command(message):
         logging.error(f"Error en comando testdirecto: {e}")
         safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
 
+@bot.message_handler(commands=['difusiones'])
+def difusiones_command(message):
+    """Comando de administrador para ver el progreso de las difusiones de mensajes directos"""
+    try:
+        if message.chat.type not in ['group', 'supergroup']:
+            safe_reply_to(message, "❌ Este comando solo funciona en grupos.")
+            return
+        
+        if not is_chat_admin(message.chat.id, message.from_user.id):
+            safe_reply_to(message, "❌ Solo los administradores pueden usar este comando.")
+            return
+        
+        text_parts = message.text.split() if message.text else []
+        if len(text_parts) > 1:
+            job = get_broadcast_job(text_parts[1])
+            if not job:
+                safe_reply_to(message, f"❌ No existe la difusión {text_parts[1]}.")
+                return
+            jobs = [job]
+        else:
+            jobs = list_broadcast_jobs()[:10]
+        
+        if not jobs:
+            safe_reply_to(message, "📝 No hay difusiones registradas.")
+            return
+        
+        status_text = "📨 DIFUSIONES DE MENSAJES DIRECTOS\n\n"
+        for job in jobs:
+            status_text += format_broadcast_job(job) + "\n"
+        
+        safe_reply_to(message, status_text, parse_mode=None)
+        
+    except Exception as e:
+        logging.error(f"Error en comando difusiones: {e}")
+        safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
+
 @bot.message_handler(commands=['eliminar_usuario'])
 def eliminar_usuario_command(message):
     """Comando de administrador para eliminar un usuario del registro de menciones del bot"""
@@ -1454,8 +4261,7 @@ def eliminar_usuario_command(message):
         
         # Verificar que el usuario que ejecuta el comando sea administrador
         try:
-            chat_member = bot.get_chat_member(chat_id, message.from_user.id)
-            if chat_member.status not in ['creator', 'administrator']:
+            if not is_chat_admin(chat_id, message.from_user.id):
                 safe_reply_to(message, "❌ Solo los administradores pueden usar este comando.")
                 logging.warning(f"⚠️ Usuario {message.from_user.id} intentó usar /eliminar_usuario sin ser administrador")
                 return
@@ -1480,6 +4286,7 @@ def eliminar_usuario_command(message):
             # Eliminar usuario
             if remove_registered_user(target_user_id):
                 registered_users.discard(target_user_id)
+                invalidate_mention_rosters()
                 
                 response_text = f"✅ Usuario eliminado del registro de menciones\n\n"
                 if username:
@@ -1514,20 +4321,12 @@ def eliminar_usuario_command(message):
                     return
                 
                 # Obtener información del usuario de la base de datos
-                try:
-                    user_info_result = supabase.table('registered_users').select('username, first_name, last_name').eq('user_id', target_user_id).execute()
-                    
-                    if user_info_result.data:
-                        user_data = user_info_result.data[0]
-                        username = user_data.get('username')
-                        first_name = user_data.get('first_name')
-                        last_name = user_data.get('last_name')
-                    else:
-                        username = None
-                        first_name = "Usuario"
-                        last_name = None
-                except Exception as db_error:
-                    logging.error(f"Error al obtener información del usuario: {db_error}")
+                user_data = get_user_info(target_user_id)
+                if user_data:
+                    username = user_data.get('username')
+                    first_name = user_data.get('first_name')
+                    last_name = user_data.get('last_name')
+                else:
                     username = None
                     first_name = "Usuario"
                     last_name = None
@@ -1535,6 +4334,7 @@ def eliminar_usuario_command(message):
                 # Eliminar usuario
                 if remove_registered_user(target_user_id):
                     registered_users.discard(target_user_id)
+                    invalidate_mention_rosters()
                     
                     response_text = f"✅ Usuario eliminado del registro de menciones\n\n"
                     if username:
@@ -1647,7 +4447,7 @@ def comunista_command(message):
         
         # Enviar mensaje directo al usuario comunista
         try:
-            bot.send_message(comunista_user_id, comunista_message)
+            run_outbound(comunista_user_id, lambda: bot.send_message(comunista_user_id, comunista_message))
             logging.info(f"✅ Mensaje comunista enviado exitosamente al usuario {comunista_user_id}")
             
             # Responder en el grupo que se envió el mensaje
@@ -1673,6 +4473,59 @@ def comunista_command(message):
         safe_reply_to(message, "❌ Ocurrió un error al procesar la solicitud.")
 
 
+@bot.middleware_handler(update_types=['message'])
+def track_message_members(bot_instance, message):
+    """Registra en el índice a quien escribe, entra o sale de un grupo.
+
+    Un mensaje privado al bot levanta además la caché negativa de mensajes
+    directos de ese usuario.
+    """
+    try:
+        if message.chat.type == 'private':
+            clear_dm_failure(message.from_user.id)
+            return
+        if message.chat.type not in ['group', 'supergroup']:
+            return
+        chat_id = message.chat.id
+        record_chat_member(chat_id, message.from_user)
+        for new_member in message.new_chat_members or []:
+            record_chat_member(chat_id, new_member, 'member')
+        if message.left_chat_member:
+            record_chat_member(chat_id, message.left_chat_member, 'left')
+        if message.new_chat_members or message.left_chat_member:
+            invalidate_chat_metadata(chat_id, 'member_count')
+    except Exception as e:
+        logging.error(f"Error al actualizar índice de miembros: {e}")
+
+@bot.chat_member_handler()
+def chat_member_update(update):
+    """Actualiza el índice cuando cambia el estado de un miembro del grupo"""
+    try:
+        new_member = update.new_chat_member
+        old_status = update.old_chat_member.status
+        record_chat_member(update.chat.id, new_member.user, new_member.status)
+        logging.info(f"👥 Chat {update.chat.id}: usuario {new_member.user.id} ahora es '{new_member.status}'")
+        
+        # Invalidar metadatos afectados por el cambio
+        admin_statuses = ['administrator', 'creator']
+        if old_status in admin_statuses or new_member.status in admin_statuses:
+            invalidate_chat_metadata(update.chat.id, 'administrators')
+        if (old_status in ACTIVE_MEMBER_STATUSES) != (new_member.status in ACTIVE_MEMBER_STATUSES):
+            invalidate_chat_metadata(update.chat.id, 'member_count')
+    except Exception as e:
+        logging.error(f"Error al procesar actualización chat_member: {e}")
+
+@bot.my_chat_member_handler()
+def my_chat_member_update(update):
+    """Olvida el índice de un chat cuando el bot sale o es expulsado"""
+    try:
+        status = update.new_chat_member.status
+        logging.info(f"🤖 Estado del bot en el chat {update.chat.id}: '{status}'")
+        invalidate_chat_metadata(update.chat.id)
+        if status in ['left', 'kicked']:
+            forget_chat(update.chat.id)
+    except Exception as e:
+        logging.error(f"Error al procesar actualización my_chat_member: {e}")
 
 def force_cleanup_all_instances():
     """Fuerza la limpieza de todas las instancias del bot"""
@@ -1729,7 +4582,7 @@ def start_bot_with_webhook():
         webhook_data = {
             'url': webhook_url,
             'max_connections': 1,
-            'allowed_updates': ['message']
+            'allowed_updates': ['message', 'callback_query', 'chat_member', 'my_chat_member']
         }
         
         response = requests.post(webhook_url, json=webhook_data, timeout=10)
@@ -1779,7 +4632,7 @@ def start_bot_with_retry():
                 long_polling_timeout=10,
                 interval=2,
                 none_stop=True,
-                allowed_updates=['message', 'callback_query']  # Solo procesar mensajes y callbacks
+                allowed_updates=['message', 'callback_query', 'chat_member', 'my_chat_member']  # Mensajes, callbacks y cambios de miembros
             )
             
         except (ConnectionError, Timeout, NewConnectionError, MaxRetryError) as e:
@@ -1854,7 +4707,33 @@ def start_web_server():
     
     @app.route('/health')
     def health():
-        return {"status": "ok", "bot": "running"}
+        return {"status": "ok", "bot": "running", "chat_metadata_cache": dict(chat_metadata_stats)}
+    
+    def broadcasts_authorized():
+        """El progreso incluye los textos de las alertas: se pide BROADCASTS_TOKEN
+        (cabecera `Authorization: Bearer <token>` o parámetro `?token=`)"""
+        if not BROADCASTS_TOKEN:
+            return False
+        header = request.headers.get('Authorization', '')
+        supplied = header[len('Bearer '):] if header.startswith('Bearer ') else request.args.get('token', '')
+        return hmac.compare_digest(supplied.encode(), BROADCASTS_TOKEN.encode())
+    
+    @app.route('/broadcasts')
+    def broadcasts():
+        """Progreso de las difusiones de mensajes directos recientes"""
+        if not broadcasts_authorized():
+            return jsonify({"status": "error", "message": "Unauthorized"}), 401
+        return jsonify({"jobs": list_broadcast_jobs()})
+    
+    @app.route('/broadcasts/<job_id>')
+    def broadcast_status(job_id):
+        """Progreso de una difusión de mensajes directos"""
+        if not broadcasts_authorized():
+            return jsonify({"status": "error", "message": "Unauthorized"}), 401
+        job = get_broadcast_job(job_id)
+        if not job:
+            return jsonify({"status": "error", "message": "Job not found"}), 404
+        return jsonify(job)
     
     @app.route('/webhook', methods=['POST'])
     def webhook():
@@ -1880,8 +4759,23 @@ def start_web_server():
     app.run(host='0.0.0.0', port=port)
 
 if __name__ == '__main__':
+    if OUTBOX_WORKER_MODE:
+        # Proceso dedicado solo a vaciar la bandeja de salida de difusiones
+        logging.info("📮 Ejecutando solo los workers de la bandeja de salida")
+        while True:
+            time.sleep(3600)
+    
+    # Sincronización de la copia local con el remoto (solo en el proceso principal del bot)
+    storage.start()
+    
+    # Cambios de usuarios hechos por otras instancias (webhook + polling, despliegues blue/green)
+    start_user_sync()
+    
+    # Mantenimiento periódico del log (solo en el proceso principal del bot)
+    threading.Thread(target=log_maintenance_worker, name='log-maintenance', daemon=True).start()
+    threading.Thread(target=outbox_cleanup_worker, name='outbox-cleanup', daemon=True).start()
+    
     # Iniciar bot en un hilo separado
-    import threading
     bot_thread = threading.Thread(target=start_bot_with_retry)
     bot_thread.daemon = True
     bot_thread.start()
@@ -0,0 +1,75 @@
+-- Bandeja de salida de difusiones: una fila por (alerta, destinatario)
+CREATE TABLE broadcast_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    alert_id TEXT NOT NULL,
+    recipient_id BIGINT NOT NULL,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    claimed_at TIMESTAMP WITH TIME ZONE,
+    sent_at TIMESTAMP WITH TIME ZONE,
+    last_error TEXT,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    UNIQUE (alert_id, recipient_id)
+);
+
+CREATE INDEX broadcast_outbox_status_idx ON broadcast_outbox (status, id);
+
+-- Si la tabla ya existía antes de los reintentos con espera:
+-- ALTER TABLE broadcast_outbox ADD COLUMN next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW();
+
+-- Reclama un lote de filas pendientes cuyo próximo intento ya llegó (o con
+-- reclamo vencido) para un worker.
+-- FOR UPDATE SKIP LOCKED permite que varios workers trabajen en paralelo sin
+-- tomar las mismas filas.
+CREATE OR REPLACE FUNCTION claim_broadcast_outbox(p_worker TEXT, p_batch_size INTEGER, p_claim_timeout INTEGER)
+RETURNS SETOF broadcast_outbox
+LANGUAGE sql
+AS $$
+    UPDATE broadcast_outbox
+    SET status = 'claimed',
+        claimed_by = p_worker,
+        claimed_at = NOW(),
+        attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM broadcast_outbox
+        WHERE (status = 'pending' AND next_attempt_at <= NOW())
+           OR (status = 'claimed' AND claimed_at < NOW() - make_interval(secs => p_claim_timeout))
+        ORDER BY id
+        LIMIT p_batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$;
+
+-- Filas por alerta y estado, para el progreso de /difusiones y /broadcasts
+-- (las entregan workers de cualquier proceso)
+CREATE OR REPLACE FUNCTION count_broadcast_outbox(p_alert_ids TEXT[])
+RETURNS TABLE (alert_id TEXT, status TEXT, count BIGINT)
+LANGUAGE sql STABLE
+AS $$
+    SELECT o.alert_id, o.status, COUNT(*)
+    FROM broadcast_outbox o
+    WHERE o.alert_id = ANY(p_alert_ids)
+    GROUP BY o.alert_id, o.status;
+$$;
+
+-- Habilitar RLS
+ALTER TABLE broadcast_outbox ENABLE ROW LEVEL SECURITY;
+
+-- Política para permitir todas las operaciones (para el bot)
+CREATE POLICY "Allow all operations" ON broadcast_outbox FOR ALL USING (true);
+
+-- Resultados de mensajes directos de los procesos `--outbox-worker`; el proceso
+-- principal los pasa a su caché negativa y los borra
+CREATE TABLE dm_failure_reports (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    failure_class TEXT,
+    reported_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+ALTER TABLE dm_failure_reports ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Allow all operations" ON dm_failure_reports FOR ALL USING (true);